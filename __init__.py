@@ -7,7 +7,14 @@ from . import account
 def register():
     Pool.register(
         account.ReconcileMovesStart,
+        account.Account,
         account.ReconcileRule,
+        account.ReconcileRun,
+        account.ReconcileRunAccount,
+        account.ReconcileRunParty,
+        account.ReconcileProposal,
+        account.ReconcileProposalLine,
+        account.Cron,
         module='account_reconcile', type_='model')
     Pool.register(
         account.ReconcileMoves,
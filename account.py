@@ -1,23 +1,74 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from itertools import combinations
-from dateutil.relativedelta import relativedelta
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from itertools import groupby
 import logging
 import re
+import string
+import time
+from uuid import uuid4
 
-from trytond.model import ModelSQL, ModelView, fields
+from sql import Asc, Column, Desc, Null, Window, With
+from sql.aggregate import Aggregate, Count, Max, Min, Sum
+from sql.conditionals import Case, Coalesce
+from sql.functions import Function, RowNumber, Substring
+from sql.operators import Exists
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import Index, ModelSQL, ModelView, Workflow, fields
 from trytond.wizard import Wizard, StateView, StateAction, Button
 from trytond.transaction import Transaction
 from trytond.pyson import Bool, Eval
-from trytond.pool import Pool
+from trytond.pool import Pool, PoolMeta
 from trytond.exceptions import UserError
 from trytond.i18n import gettext
+from trytond.tools import grouped_slice
+
+from .combination import (CombinationMatcher, SubsetSumMatcher,
+    estimate_cost, max_size, scale_amounts, MAX_PAIRS, MAX_STATES)
+from .metrics import MetricsEmitter
 
 
-__all__ = ['ReconcileMovesStart', 'ReconcileMoves']
+__all__ = ['ReconcileMovesStart', 'Account', 'ReconcileRun',
+    'ReconcileRunAccount', 'ReconcileRunParty', 'ReconcileProposal',
+    'ReconcileProposalLine', 'ReconcileMoves', 'Cron']
 logger = logging.getLogger(__name__)
 
+# Number of rows fetched at once from the server-side cursor
+FETCH_SIZE = 10000
+# Default number of groups of lines reconciled at once
+BATCH_SIZE = 500
+# Minimum seconds given to search the combinations of a group
+MIN_SLICE = 0.05
+# Default maximum number of candidates estimated to search a group
+MAX_CANDIDATES = 100000000
+# Default maximum number of lines of a group kept on the window
+WINDOW_LINES = 100000
+# Default number of lines entering the window on each slide
+WINDOW_TARGET = 20000
+# Default seconds before the start of an incremental run of its watermark
+WATERMARK_MARGIN = 3600
+# Expressions that can not be combined in a single alternation pattern
+BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+# The bounds of a quantifier accepted by PostgreSQL regular expressions
+PORTABLE_BOUND = re.compile(r'\{(\d+)(?:,(\d*))?\}')
+# The maximum bound of a quantifier on PostgreSQL regular expressions
+PORTABLE_MAX_BOUND = 255
+
+
+class ArrayAgg(Aggregate):
+    __slots__ = ()
+    _sql = 'ARRAY_AGG'
+
+
+class Replace(Function):
+    __slots__ = ()
+    _function = 'REPLACE'
+
 
 class ReconcileMovesStart(ModelView):
     'Reconcile Moves'
@@ -47,11 +98,55 @@ class ReconcileMovesStart(ModelView):
             states={'invisible': ~Bool(Eval('use_combinations'))})
     max_days = fields.Integer('Maximum days', required=True,
         help='Maximum difference in days of lines to reconcile.')
+    use_subset_sum = fields.Boolean('Use Subset Sum',
+        help=('Search also the groups of one line and more lines of the '
+            'opposite sign than the maximum lines, like a payment of many '
+            'invoices.'),
+        states={'invisible': ~Bool(Eval('use_combinations'))})
+    max_subset_lines = fields.Integer('Maximum Subset Lines',
+        help='Maximum number of lines of the groups found by subset sum.',
+        states={
+            'invisible': ~Bool(Eval('use_subset_sum')),
+            'required': Bool(Eval('use_subset_sum')),
+            })
+    max_span = fields.Integer('Maximum Span',
+        help=('Maximum difference in days among the lines of a '
+            'combination.\nNo limit if empty.'),
+        states={'invisible': ~Bool(Eval('use_combinations'))})
+    tolerance = fields.Numeric('Tolerance',
+        help=('Maximum difference from zero of the amounts of a '
+            'combination.\nThe difference is posted with the write off '
+            'method.'),
+        states={'invisible': ~Bool(Eval('use_combinations'))})
+    write_off = fields.Many2One('account.move.reconcile.write_off',
+        'Write Off',
+        domain=[('company', '=', Eval('company', -1))],
+        states={
+            'invisible': ~Bool(Eval('tolerance')),
+            'required': Bool(Eval('tolerance')),
+            })
     start_date = fields.Date('Start Date')
     end_date = fields.Date('End Date')
     timeout = fields.TimeDelta('Maximum Computation Time', required=True)
     use_combinations = fields.Boolean("Use Combinations")
     use_rules = fields.Boolean("Use Rules")
+    use_references = fields.Boolean("Use References",
+        help="Reconcile first the lines that share a reference and whose "
+        "amounts sum zero.")
+    references = fields.MultiSelection('get_references', "References",
+        states={
+            'invisible': ~Bool(Eval('use_references')),
+            'required': Bool(Eval('use_references')),
+            },
+        help="The references tried in order to group the lines.")
+    background = fields.Boolean("Run in Background",
+        help="Reconcile each account on a separate task of the queue.")
+    propose = fields.Boolean("Propose Only",
+        help="Store the groups of lines found as proposals to approve "
+        "instead of reconciling them.")
+    incremental = fields.Boolean("Only Changed Groups",
+        help="Only reconcile the account and party groups with lines "
+        "created or modified since the last incremental run.")
 
     @staticmethod
     def default_company():
@@ -65,6 +160,10 @@ class ReconcileMovesStart(ModelView):
     def default_max_days():
         return 60
 
+    @staticmethod
+    def default_max_subset_lines():
+        return 20
+
     @staticmethod
     def default_timeout():
         return timedelta(minutes=5)
@@ -73,6 +172,37 @@ class ReconcileMovesStart(ModelView):
     def default_use_combinations():
         return True
 
+    @staticmethod
+    def default_references():
+        return ['move_origin']
+
+    @classmethod
+    def get_references(cls):
+        'Return the references that can group the lines to reconcile'
+        return [
+            ('move_origin', "Move Origin"),
+            ('line_origin', "Line Origin"),
+            ('move_description', "Move Description"),
+            ]
+
+
+class Account(metaclass=PoolMeta):
+    __name__ = 'account.account'
+
+    @classmethod
+    def reconcile_moves(cls, accounts, values):
+        '''
+        Reconcile the lines of accounts using the values of the
+        account.move_reconcile.start view
+        '''
+        pool = Pool()
+        ReconcileMoves = pool.get('account.move_reconcile', type='wizard')
+        values = values.copy()
+        values['accounts'] = [a.id for a in accounts]
+        # Timed out tasks are continued on a new task
+        with Transaction().set_context(reconcile_continue=True):
+            ReconcileMoves.run(values)
+
 
 class ReconcileRule(ModelSQL, ModelView):
     'Reconcile Rule'
@@ -83,10 +213,1085 @@ class ReconcileRule(ModelSQL, ModelView):
     expression = fields.Char('Regular Expression',
         help='Example: Invoice nº((\\d|\\s)+)')
 
+    _expressions_cache = Cache('account.move_reconcile.rule.expressions',
+        context=False)
+
     @staticmethod
     def default_company():
         return Transaction().context.get('company')
 
+    @classmethod
+    def create(cls, vlist):
+        rules = super().create(vlist)
+        cls._expressions_cache.clear()
+        return rules
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        cls._expressions_cache.clear()
+
+    @classmethod
+    def delete(cls, rules):
+        super().delete(rules)
+        cls._expressions_cache.clear()
+
+    @classmethod
+    def get_expressions(cls, company, account):
+        '''
+        Return the RuleExpressions of the rules of account in company
+
+        The expressions are compiled once and cached until a rule is
+        modified.
+        '''
+        key = (company, account)
+        expressions = cls._expressions_cache.get(key)
+        if expressions is not None:
+            return expressions
+        rules = cls.search([
+                ('account', '=', account),
+                ('company', '=', company),
+                ], order=[('id', 'ASC')])
+        for rule in rules:
+            try:
+                re.compile(rule.expression)
+            except:
+                raise UserError(gettext(
+                    'account_reconcile.msg_wrong_expression',
+                    expression=rule.expression, rule=rule.id))
+        expressions = RuleExpressions([r.expression for r in rules])
+        cls._expressions_cache.set(key, expressions)
+        return expressions
+
+
+class RuleExpressions(object):
+    '''
+    The compiled expressions of the reconcile rules of an account
+
+    The key of a description is the first group of the first expression that
+    matches it. When possible the expressions are combined in a single
+    alternation pattern so the description is scanned once instead of once
+    per expression.
+    '''
+
+    def __init__(self, expressions):
+        self.regexes = [re.compile(x) for x in expressions]
+        # The expressions can be evaluated by PostgreSQL with the same result
+        self.portable = all(self.is_portable(x) for x in expressions)
+        self.pattern = None
+        self.groups = []
+        if (len(expressions) > 1
+                and not any(BACKREFERENCE.search(x) for x in expressions)):
+            try:
+                self.pattern = re.compile('|'.join('(?P<rule%d>%s)' % x
+                        for x in enumerate(expressions)))
+            except re.error:
+                # Inline flags or named groups that clash among expressions
+                pass
+        if self.pattern is not None:
+            self.groups = [self.pattern.groupindex['rule%d' % i]
+                for i in range(len(expressions))]
+
+    def __bool__(self):
+        return bool(self.regexes)
+
+    @staticmethod
+    def is_portable(expression):
+        """
+        Return if PostgreSQL extracts the same key from the expression
+
+        Only the syntax that behaves the same is accepted: literals, escaped
+        punctuation, bracket expressions of them and of ASCII ranges, the
+        anchors ^, \\A and \\Z, unquantified groups and the greedy
+        quantifiers of a single atom. There must be exactly one capturing
+        group so it always participates in the match. Without alternation
+        or quantified groups, the leftmost match found by Python is also the
+        longest one returned by PostgreSQL.
+        """
+        groups = 0
+        # The previous token is a single atom that can be quantified
+        atom = False
+        i = 0
+        while i < len(expression):
+            char = expression[i]
+            if char == '\\':
+                escaped = expression[i + 1:i + 2]
+                if escaped in {'A', 'Z'}:
+                    atom = False
+                elif escaped and escaped in string.punctuation:
+                    atom = True
+                else:
+                    # \\d, \\w or \\s depend on Unicode or on the locale
+                    return False
+                i += 2
+            elif char == '[':
+                i += 1
+                if expression[i:i + 1] == '^':
+                    i += 1
+                start = i
+                while i < len(expression) and (
+                        expression[i] != ']' or i == start):
+                    if expression[i] == '\\':
+                        escaped = expression[i + 1:i + 2]
+                        if not escaped or escaped not in string.punctuation:
+                            return False
+                        i += 2
+                        continue
+                    elif expression[i] == '[':
+                        # Character classes or collating elements
+                        return False
+                    elif (expression[i] == '-' and i > start
+                            and expression[i + 1:i + 2] != ']'):
+                        first, last = expression[i - 1], expression[i + 1]
+                        if not (first.isascii() and first.isalnum()
+                                and last.isascii() and last.isalnum()):
+                            return False
+                    i += 1
+                if i >= len(expression):
+                    return False
+                atom = True
+                i += 1
+            elif char == '(':
+                if expression[i + 1:i + 2] == '?':
+                    if expression[i + 2:i + 3] != ':':
+                        # Flags, named groups or assertions
+                        return False
+                    i += 3
+                else:
+                    groups += 1
+                    i += 1
+                atom = False
+            elif char in {')', '^'}:
+                atom = False
+                i += 1
+            elif char in {'*', '+', '?', '{'}:
+                if not atom:
+                    # Quantified groups may not participate or match less
+                    # than the longest
+                    return False
+                if char == '{':
+                    match = PORTABLE_BOUND.match(expression, i)
+                    if not match:
+                        return False
+                    if any(int(x) > PORTABLE_MAX_BOUND
+                            for x in match.groups() if x):
+                        return False
+                    i = match.end()
+                else:
+                    i += 1
+                if expression[i:i + 1] in {'?', '+'}:
+                    # Non greedy or possessive quantifiers
+                    return False
+                atom = False
+            elif char in {'.', '$', '|', ']', '}'}:
+                # The dot and the dollar differ on the new lines and the
+                # alternation returns the first match instead of the longest
+                return False
+            else:
+                atom = True
+                i += 1
+        return groups == 1
+
+    def key(self, description):
+        'Return the key extracted from description or None'
+        if not description:
+            return
+        if self.pattern is None:
+            for regex in self.regexes:
+                match = regex.search(description)
+                if match:
+                    return match.group(1).replace(' ', '')
+            return
+        match = self.pattern.search(description)
+        if not match:
+            return
+        index = int(match.lastgroup[4:])
+        # The previous expressions did not match up to this position but they
+        # could match further and they have precedence
+        for regex in self.regexes[:index]:
+            other = regex.search(description, match.start() + 1)
+            if other:
+                return other.group(1).replace(' ', '')
+        return match.group(self.groups[index] + 1).replace(' ', '')
+
+
+class ReconcileRun(ModelSQL, ModelView):
+    'Reconcile Run'
+    __name__ = 'account.move_reconcile.run'
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True)
+    accounts = fields.Many2Many('account.move_reconcile.run-account.account',
+        'run', 'account', 'Accounts', readonly=True)
+    parties = fields.Many2Many('account.move_reconcile.run-party.party',
+        'run', 'party', 'Parties', readonly=True,
+        context={
+            'company': Eval('company', -1),
+        },
+        depends=['company'])
+    max_lines = fields.Integer('Maximum Lines', readonly=True)
+    max_days = fields.Integer('Maximum days', readonly=True)
+    use_subset_sum = fields.Boolean('Use Subset Sum', readonly=True)
+    max_subset_lines = fields.Integer('Maximum Subset Lines', readonly=True)
+    max_span = fields.Integer('Maximum Span', readonly=True)
+    tolerance = fields.Numeric('Tolerance', readonly=True)
+    write_off = fields.Many2One('account.move.reconcile.write_off',
+        'Write Off', readonly=True)
+    start_date = fields.Date('Start Date', readonly=True)
+    end_date = fields.Date('End Date', readonly=True)
+    timeout = fields.TimeDelta('Maximum Computation Time', readonly=True)
+    use_combinations = fields.Boolean("Use Combinations", readonly=True)
+    use_rules = fields.Boolean("Use Rules", readonly=True)
+    use_references = fields.Boolean("Use References", readonly=True)
+    references = fields.MultiSelection('get_references', "References",
+        readonly=True)
+    propose = fields.Boolean("Propose Only", readonly=True)
+    incremental = fields.Boolean("Only Changed Groups", readonly=True)
+    watermark = fields.DateTime('Watermark', readonly=True,
+        help='Start of the run minus the watermark margin, the lines created '
+        'or modified after it are revisited by the next incremental run.')
+    since = fields.DateTime('Since', readonly=True,
+        help='Watermark after which the lines were created or modified.')
+    batch = fields.Char('Batch', readonly=True,
+        help='Identifier shared by the runs of the same incremental '
+        'reconciliation split in tasks or partitions.')
+    tasks = fields.Integer('Tasks', readonly=True,
+        help='Number of tasks or partitions of the batch.\n'
+        'Only the run of the batch records its watermark, once all of them '
+        'are done.')
+    start_time = fields.DateTime('Start Time', readonly=True)
+    end_time = fields.DateTime('End Time', readonly=True)
+    partition = fields.Integer('Partition', readonly=True)
+    partitions = fields.Integer('Partitions', readonly=True)
+    state = fields.Selection([
+            ('running', 'Running'),
+            ('done', 'Done'),
+            ('timeout', 'Timeout'),
+            ('resumed', 'Resumed'),
+            ], 'State', readonly=True)
+    checkpoint_date = fields.Date('Checkpoint Date', readonly=True,
+        help='Start date of the window being reconciled on timeout.')
+    checkpoint_account = fields.Many2One('account.account',
+        'Checkpoint Account', readonly=True)
+    checkpoint_party = fields.Many2One('party.party', 'Checkpoint Party',
+        readonly=True,
+        context={
+            'company': Eval('company', -1),
+            },
+        depends=['company'])
+    checkpoint_size = fields.Integer('Checkpoint Size', readonly=True,
+        help='Combination size reached on the checkpoint account and party.\n'
+        'Empty if the account and party were completed.')
+    checkpoint_cost = fields.Numeric('Checkpoint Cost', readonly=True,
+        help='Candidates estimated for the checkpoint account and party, '
+        'the groups of a window are processed from the cheapest.')
+    lines = fields.Integer('Lines Scanned', readonly=True)
+    groups = fields.Integer('Groups Processed', readonly=True)
+    combinations = fields.Integer('Combinations Evaluated', readonly=True)
+    rule_matches = fields.Integer('Rule Matches', readonly=True)
+    reference_matches = fields.Integer('Reference Matches', readonly=True)
+    combination_matches = fields.Integer('Combination Matches',
+        readonly=True)
+    downgraded = fields.Integer('Groups Downgraded', readonly=True,
+        help='Groups with too many lines to search all the combinations.')
+    downgrades = fields.Text('Downgrades', readonly=True)
+    evicted = fields.Integer('Lines Evicted', readonly=True,
+        help='Older lines left out of the groups with more lines than the '
+        'window keeps.')
+    reconciled = fields.Integer('Lines Reconciled', readonly=True)
+    fetch_duration = fields.TimeDelta('Fetch Time', readonly=True)
+    regex_duration = fields.TimeDelta('Regular Expression Time',
+        readonly=True)
+    search_duration = fields.TimeDelta('Search Time', readonly=True)
+    write_duration = fields.TimeDelta('Write Time', readonly=True)
+    lines_per_second = fields.Function(fields.Float('Lines per Second',
+            digits=(16, 2)), 'get_lines_per_second')
+    proposals = fields.One2Many('account.move_reconcile.proposal', 'run',
+        'Proposals', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('start_time', 'DESC'))
+        cls._buttons.update({
+                'resume': {
+                    'invisible': Eval('state') != 'timeout',
+                    'depends': ['state'],
+                    },
+                'apply_proposals': {
+                    'invisible': ~Eval('propose'),
+                    'depends': ['propose'],
+                    },
+                })
+
+    @staticmethod
+    def default_state():
+        return 'running'
+
+    @classmethod
+    def get_references(cls):
+        pool = Pool()
+        Start = pool.get('account.move_reconcile.start')
+        return Start.get_references()
+
+    def get_lines_per_second(self, name):
+        if self.start_time and self.end_time and self.lines:
+            seconds = (self.end_time - self.start_time).total_seconds()
+            if seconds:
+                return self.lines / seconds
+
+    @property
+    def checkpoint_group(self):
+        if self.checkpoint_account:
+            return (self.checkpoint_account.id,
+                self.checkpoint_party.id if self.checkpoint_party else None)
+
+    def get_checkpoint(self):
+        return (self.checkpoint_date, self.checkpoint_group,
+            self.checkpoint_size, self.checkpoint_cost)
+
+    def get_start_values(self):
+        '''
+        Return the values of account.move_reconcile.start to continue from
+        the checkpoint
+        '''
+        return {
+            'company': self.company.id,
+            'accounts': [a.id for a in self.accounts],
+            'parties': [p.id for p in self.parties],
+            'max_lines': str(self.max_lines),
+            'max_days': self.max_days,
+            'use_subset_sum': self.use_subset_sum,
+            'max_subset_lines': self.max_subset_lines,
+            'max_span': self.max_span,
+            'tolerance': self.tolerance,
+            'write_off': self.write_off.id if self.write_off else None,
+            'start_date': self.checkpoint_date,
+            'end_date': self.end_date,
+            'timeout': self.timeout,
+            'use_combinations': self.use_combinations,
+            'use_rules': self.use_rules,
+            'use_references': self.use_references,
+            'references': list(self.references or []),
+            'propose': self.propose,
+            'incremental': self.incremental,
+            'background': False,
+            }
+
+    @classmethod
+    def get_watermark(cls, company):
+        'Return the watermark of the last incremental run of company done'
+        runs = cls.search([
+                ('company', '=', company),
+                ('incremental', '=', True),
+                ('state', '=', 'done'),
+                ('watermark', '!=', None),
+                ], order=[('start_time', 'DESC'), ('id', 'DESC')], limit=1)
+        if runs:
+            return runs[0].watermark
+
+    @classmethod
+    def complete_batch(cls, batch):
+        'Set the run of batch as done if all its tasks are done'
+        runs = cls.search([
+                ('batch', '=', batch),
+                ('tasks', '!=', None),
+                ('state', '=', 'running'),
+                ])
+        if not runs:
+            return
+        cls.lock(runs)
+        run, = runs
+        done = cls.search_count([
+                ('batch', '=', batch),
+                ('tasks', '=', None),
+                ('state', '=', 'done'),
+                ])
+        if done >= run.tasks:
+            run.state = 'done'
+            run.end_time = datetime.now()
+            run.save()
+
+    @classmethod
+    def reconcile_incremental(cls):
+        '''
+        Reconcile the groups of lines of the company of the context changed
+        since the last incremental run with the default parameters
+        '''
+        pool = Pool()
+        Start = pool.get('account.move_reconcile.start')
+        ReconcileMoves = pool.get('account.move_reconcile', type='wizard')
+        company = Transaction().context.get('company')
+        if not company:
+            return
+        values = Start.default_get(list(Start._fields), with_rec_name=False)
+        values.update({
+                'company': company,
+                'accounts': [],
+                'parties': [],
+                'start_date': None,
+                'end_date': None,
+                'use_rules': True,
+                'incremental': True,
+                'background': False,
+                })
+        # Timed out runs are continued on a new task
+        with Transaction().set_context(reconcile_continue=True):
+            ReconcileMoves.run(values)
+
+    @classmethod
+    @ModelView.button
+    def resume(cls, runs):
+        'Continue the timed out runs from their checkpoint'
+        pool = Pool()
+        ReconcileMoves = pool.get('account.move_reconcile', type='wizard')
+        runs = [r for r in runs if r.state == 'timeout']
+        cls.write(runs, {'state': 'resumed'})
+        for run in runs:
+            context = {
+                'reconcile_resume': run.id,
+                }
+            if run.incremental:
+                context['reconcile_since'] = run.since
+            if run.batch:
+                context['reconcile_batch'] = run.batch
+            if run.partitions:
+                context['reconcile_partition'] = (
+                    run.partition, run.partitions)
+            with Transaction().set_context(context):
+                ReconcileMoves.run(run.get_start_values())
+
+    @classmethod
+    @ModelView.button
+    def apply_proposals(cls, runs):
+        'Reconcile the approved proposals of the runs'
+        pool = Pool()
+        Proposal = pool.get('account.move_reconcile.proposal')
+        Proposal.apply([p for r in runs for p in r.proposals
+                if p.state == 'approved'])
+
+    @classmethod
+    def create_from_start(cls, start):
+        'Create a run with the parameters of account.move_reconcile.start'
+        context = Transaction().context
+        partition, partitions = context.get(
+            'reconcile_partition') or (None, None)
+        run = cls(
+            company=start.company,
+            accounts=start.accounts,
+            parties=start.parties,
+            max_lines=int(start.max_lines),
+            max_days=start.max_days,
+            use_subset_sum=start.use_subset_sum,
+            max_subset_lines=start.max_subset_lines,
+            max_span=start.max_span,
+            tolerance=start.tolerance,
+            write_off=start.write_off,
+            start_date=start.start_date,
+            end_date=start.end_date,
+            timeout=start.timeout,
+            use_combinations=start.use_combinations,
+            use_rules=start.use_rules,
+            use_references=start.use_references,
+            references=start.references,
+            propose=start.propose,
+            incremental=start.incremental,
+            since=context.get('reconcile_since'),
+            batch=context.get('reconcile_batch'),
+            partition=partition,
+            partitions=partitions,
+            start_time=datetime.now(),
+            )
+        run.save()
+        return run
+
+    def finish(self, statistics, reconciled, checkpoint=None):
+        '''
+        Store the statistics of the run and the (date, group, size, cost)
+        checkpoint if it did not complete
+        '''
+        self.end_time = datetime.now()
+        self.state = 'timeout' if checkpoint else 'done'
+        if checkpoint:
+            date, group, size, cost = checkpoint
+            account, party = group or (None, None)
+            self.checkpoint_date = date
+            self.checkpoint_account = account
+            self.checkpoint_party = party
+            self.checkpoint_size = size
+            self.checkpoint_cost = cost
+        self.reconciled = reconciled
+        self.downgrades = '\n'.join(statistics.get_downgrades()) or None
+        for name in statistics.counters:
+            setattr(self, name, getattr(statistics, name))
+        for name in statistics.timers:
+            setattr(self, '%s_duration' % name,
+                timedelta(seconds=statistics.times[name]))
+        self.save()
+
+
+class ReconcileRunAccount(ModelSQL):
+    'Reconcile Run - Account'
+    __name__ = 'account.move_reconcile.run-account.account'
+    run = fields.Many2One('account.move_reconcile.run', 'Run',
+        ondelete='CASCADE', required=True)
+    account = fields.Many2One('account.account', 'Account',
+        ondelete='CASCADE', required=True)
+
+
+class ReconcileRunParty(ModelSQL):
+    'Reconcile Run - Party'
+    __name__ = 'account.move_reconcile.run-party.party'
+    run = fields.Many2One('account.move_reconcile.run', 'Run',
+        ondelete='CASCADE', required=True)
+    party = fields.Many2One('party.party', 'Party', ondelete='CASCADE',
+        required=True)
+
+
+class ReconcileProposal(Workflow, ModelSQL, ModelView):
+    'Reconcile Proposal'
+    __name__ = 'account.move_reconcile.proposal'
+    run = fields.Many2One('account.move_reconcile.run', 'Run',
+        required=True, readonly=True, ondelete='CASCADE')
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True)
+    account = fields.Many2One('account.account', 'Account', required=True,
+        readonly=True)
+    party = fields.Many2One('party.party', 'Party', readonly=True,
+        context={
+            'company': Eval('company', -1),
+            },
+        depends=['company'])
+    strategy = fields.Selection([
+            ('reference', 'Reference'),
+            ('rule', 'Rule'),
+            ('pair', 'Pair'),
+            ('combination', 'Combination'),
+            ('subset', 'Subset Sum'),
+            ], 'Strategy', readonly=True)
+    lines = fields.Many2Many(
+        'account.move_reconcile.proposal-account.move.line', 'proposal',
+        'line', 'Lines', readonly=True,
+        help='The lines to reconcile together.')
+    state = fields.Selection([
+            ('proposed', 'Proposed'),
+            ('approved', 'Approved'),
+            ('applied', 'Applied'),
+            ('cancelled', 'Cancelled'),
+            ], 'State', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls._order.insert(0, ('run', 'DESC'))
+        cls._transitions |= set((
+                ('proposed', 'approved'),
+                ('approved', 'proposed'),
+                ('proposed', 'cancelled'),
+                ('approved', 'cancelled'),
+                ('approved', 'applied'),
+                ))
+        cls._buttons.update({
+                'propose': {
+                    'invisible': Eval('state') != 'approved',
+                    'depends': ['state'],
+                    },
+                'approve': {
+                    'invisible': Eval('state') != 'proposed',
+                    'depends': ['state'],
+                    },
+                'cancel': {
+                    'invisible': ~Eval('state').in_(['proposed', 'approved']),
+                    'depends': ['state'],
+                    },
+                'apply': {
+                    'invisible': Eval('state') != 'approved',
+                    'depends': ['state'],
+                    },
+                })
+
+    @staticmethod
+    def default_state():
+        return 'proposed'
+
+    def get_line_ids(self):
+        return [l.id for l in self.lines]
+
+    @classmethod
+    def get_pending_where(cls, line):
+        '''
+        Return the condition on the line table for the lines of the pending
+        proposals
+        '''
+        pool = Pool()
+        ProposalLine = pool.get(
+            'account.move_reconcile.proposal-account.move.line')
+        table = cls.__table__()
+        proposal_line = ProposalLine.__table__()
+        return Exists(proposal_line.join(table,
+                condition=proposal_line.proposal == table.id
+                ).select(proposal_line.id,
+                where=((proposal_line.line == line.id)
+                    & table.state.in_(['proposed', 'approved']))))
+
+    @classmethod
+    def create_from_window(cls, run, proposals):
+        'Create the proposals of run from the (group, strategy, ids)'
+        return cls.create([{
+                    'run': run.id,
+                    'company': run.company.id,
+                    'account': account,
+                    'party': party,
+                    'strategy': strategy,
+                    'lines': [('add', ids)],
+                    } for (account, party), strategy, ids in proposals])
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('proposed')
+    def propose(cls, proposals):
+        pass
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('approved')
+    def approve(cls, proposals):
+        pass
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('cancelled')
+    def cancel(cls, proposals):
+        pass
+
+    @classmethod
+    @ModelView.button
+    @Workflow.transition('applied')
+    def apply(cls, proposals):
+        '''
+        Reconcile the lines of the proposals in batches
+
+        The proposals with some line already reconciled or whose amounts do
+        not sum zero, within the tolerance of their run, any more are
+        cancelled.
+        '''
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        ids = [i for p in proposals for i in p.get_line_ids()]
+        amounts = {}
+        for sub_ids in grouped_slice(ids):
+            for line in Line.search([
+                        ('id', 'in', list(sub_ids)),
+                        ('reconciliation', '=', None),
+                        ]):
+                amounts[line.id] = line.debit - line.credit
+        # The differences are written off with the method of each run
+        buffers = {}
+        cancelled = []
+        for proposal in proposals:
+            line_ids = proposal.get_line_ids()
+            tolerance = proposal.run.tolerance or 0
+            if (all(i in amounts for i in line_ids)
+                    and abs(sum(amounts.pop(i) for i in line_ids))
+                    <= tolerance):
+                write_off = proposal.run.write_off
+                if write_off not in buffers:
+                    buffers[write_off] = ReconcileBuffer(write_off=write_off)
+                buffers[write_off].add(line_ids)
+            else:
+                cancelled.append(proposal)
+        for buffer in buffers.values():
+            buffer.flush()
+        cls.write(cancelled, {'state': 'cancelled'})
+
+
+class ReconcileProposalLine(ModelSQL):
+    'Reconcile Proposal - Line'
+    __name__ = 'account.move_reconcile.proposal-account.move.line'
+    proposal = fields.Many2One('account.move_reconcile.proposal', 'Proposal',
+        ondelete='CASCADE', required=True)
+    line = fields.Many2One('account.move.line', 'Line', ondelete='CASCADE',
+        required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_indexes.add(Index(t, (t.line, Index.Range())))
+
+
+class ReconcileBuffer(object):
+    '''
+    Accumulate groups of lines to reconcile and reconcile them in batches of
+    size groups (account_reconcile.batch_size configuration option)
+
+    If proposals is a list, the groups are appended to it as (group,
+    strategy, ids) instead of being reconciled. The groups whose amounts do
+    not sum zero are reconciled with the write_off method.
+    '''
+
+    def __init__(self, size=None, statistics=None, proposals=None,
+            write_off=None):
+        if size is None:
+            size = config.getint('account_reconcile', 'batch_size',
+                default=BATCH_SIZE)
+        if statistics is None:
+            statistics = ReconcileStatistics()
+        self.size = max(size, 1)
+        self.statistics = statistics
+        self.proposals = proposals
+        self.write_off = write_off
+        self.groups = []
+        self.reconciled = set()
+
+    def add(self, ids, group=None, strategy=None):
+        self.groups.append((group, strategy, list(ids)))
+        self.reconciled.update(ids)
+        if len(self.groups) >= self.size:
+            self.flush()
+
+    def flush(self):
+        'Reconcile the pending groups and return the ids reconciled so far'
+        Line = Pool().get('account.move.line')
+        if self.groups and self.proposals is not None:
+            self.proposals.extend(self.groups)
+            self.groups = []
+        elif self.groups:
+            start_time = time.perf_counter()
+            with self.statistics.timer('write'):
+                lines = Line.browse(
+                    [i for _, _, ids in self.groups for i in ids])
+                groups, start = [], 0
+                for _, _, ids in self.groups:
+                    groups.append(lines[start:start + len(ids)])
+                    start += len(ids)
+                balanced = [g for g in groups
+                    if not sum(l.debit - l.credit for l in g)]
+                if balanced:
+                    Line.reconcile(*balanced)
+                if len(balanced) < len(groups):
+                    Line.reconcile(*[g for g in groups
+                            if sum(l.debit - l.credit for l in g)],
+                        writeoff=self.write_off)
+            self.statistics.notify('flush', groups=len(groups),
+                lines=len(lines),
+                seconds=time.perf_counter() - start_time)
+            self.groups = []
+        return list(self.reconciled)
+
+
+class ReconcileStatistics(object):
+    '''
+    Counters and timers of a reconciliation
+
+    The time of each timer excludes the time spent on the timers started
+    inside it.
+    '''
+    counters = ['lines', 'groups', 'combinations', 'reference_matches',
+        'rule_matches', 'combination_matches', 'downgraded', 'evicted']
+    timers = ['fetch', 'regex', 'search', 'write']
+
+    def __init__(self, listeners=None):
+        for name in self.counters:
+            setattr(self, name, 0)
+        self.times = dict.fromkeys(self.timers, 0.)
+        # Callables receiving the events of the reconciliation, see metrics
+        self.listeners = list(listeners or [])
+        # (group, lines, cost, size) of the downgraded groups
+        self.downgrades = []
+        self._running = []
+        self._start = None
+
+    def notify(self, event, **values):
+        'Send event with values to the listeners'
+        for listener in self.listeners:
+            listener(event, values)
+
+    def close(self):
+        'Close the listeners'
+        for listener in self.listeners:
+            if hasattr(listener, 'close'):
+                listener.close()
+
+    def values(self):
+        'Return the counters and the timers'
+        values = {x: getattr(self, x) for x in self.counters}
+        for name in self.timers:
+            values['%s_seconds' % name] = self.times[name]
+        return values
+
+    def downgrade(self, group, lines, cost, size):
+        '''
+        Record that the combinations of group, with cost estimated for its
+        lines, are only searched up to size lines
+        '''
+        self.downgraded += 1
+        self.downgrades.append((group, lines, cost, size))
+
+    def get_downgrades(self):
+        'Return a description of each downgraded group'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Party = pool.get('party.party')
+        for (account, party), lines, cost, size in self.downgrades:
+            name = Account(account).rec_name
+            if party:
+                name += ' / ' + Party(party).rec_name
+            if size < 2:
+                reason = gettext('account_reconcile.msg_downgrade_skipped')
+            else:
+                reason = gettext('account_reconcile.msg_downgrade_size',
+                    size=size)
+            yield gettext('account_reconcile.msg_downgrade',
+                group=name, lines=lines, cost=cost, reason=reason)
+
+    def _elapse(self):
+        now = time.perf_counter()
+        if self._running:
+            self.times[self._running[-1]] += now - self._start
+        self._start = now
+
+    @contextmanager
+    def timer(self, name):
+        self._elapse()
+        self._running.append(name)
+        try:
+            yield
+        finally:
+            self._elapse()
+            self._running.pop()
+
+
+class ReconcileScheduler(object):
+    """
+    Share the time budget of a reconciliation among its groups of lines
+
+    The remaining time is divided evenly among the windows left and the
+    share of a window evenly among its groups left, so a group with
+    thousands of lines can not starve the others. The groups that exceed
+    their slice are deferred to the end of the window and continued until
+    the share of the window is spent, so they can not starve the next
+    windows either.
+
+    The times are taken from a monotonic clock.
+    """
+
+    def __init__(self, timeout):
+        self.deadline = time.monotonic() + timeout.total_seconds()
+        self.windows = 1
+
+    def remaining(self):
+        'Return the seconds left'
+        return max(self.deadline - time.monotonic(), 0)
+
+    def expired(self):
+        return time.monotonic() > self.deadline
+
+    def share(self):
+        'Return the deadline of the share of the current window'
+        return min(time.monotonic() + self.remaining() / self.windows,
+            self.deadline)
+
+    def slice(self, deadline, groups):
+        """
+        Return the deadline of a group when groups, including it, are left
+        to process until deadline
+        """
+        budget = max(deadline - time.monotonic(), 0) / max(groups, 1)
+        return min(time.monotonic() + max(budget, MIN_SLICE), self.deadline)
+
+
+class ReconcilePlanner(object):
+    '''
+    Plan the date windows of a reconciliation from the (date, count)
+    histogram of the lines to reconcile
+
+    Each window spans max_days and the next one starts at most half of it
+    later, so the lines less than that apart always share a window. The
+    spans without lines are skipped and the windows of dense periods start
+    earlier, so that at most target lines enter each window unless a single
+    day has more.
+    '''
+
+    def __init__(self, histogram, max_days, target):
+        self.dates = [x[0] for x in histogram]
+        # Number of lines before each date
+        self.totals = [0]
+        for _, count in histogram:
+            self.totals.append(self.totals[-1] + count)
+        self.max_days = max_days
+        self.target = max(target, 1)
+
+    def count(self, after, end):
+        'Return the number of lines after after up to end'
+        return (self.totals[bisect_right(self.dates, end)]
+            - self.totals[bisect_right(self.dates, after)])
+
+    def plan(self, start_date, end_date):
+        'Yield the (start, end) of the windows between the dates'
+        days = timedelta(days=self.max_days)
+        first = bisect_left(self.dates, start_date)
+        if first == len(self.dates) or self.dates[first] > end_date:
+            return
+        start = self.dates[first]
+        while True:
+            end = min(start + days, end_date)
+            yield start, end
+            following = bisect_right(self.dates, end)
+            if end >= end_date or following == len(self.dates):
+                return
+            # The largest step that does not add more than target lines
+            lower, upper = 1, max(1, self.max_days // 2)
+            while lower < upper:
+                step = (lower + upper + 1) // 2
+                if self.count(end, start + timedelta(days=step) + days) > (
+                        self.target):
+                    upper = step - 1
+                else:
+                    lower = step
+            # Jump to the first window with the following line
+            start = max(start + timedelta(days=lower),
+                self.dates[following] - days)
+
+
+class ReconcileWindow(object):
+    '''
+    Lines pending to reconcile on a date window sliding over the period to
+    reconcile, grouped by account and party.
+
+    Each line is stored as a compact (id, date, amount, key) tuple where
+    date is an ordinal, amount an integer scaled by digits (see
+    scale_amounts), which are increased if a line has more decimals, and key
+    the one extracted by the reconcile rules. fresh stores for each group
+    that received lines on the last slide the position of the first new
+    line. changed stores for each group the keys of the
+    lines that left it on the last slide, as the remaining lines of those
+    keys may sum zero now. The groups with changed keys are also in fresh,
+    after their last line if they did not receive any.
+
+    If max_lines is given, a group keeps at most its max_lines latest lines
+    so the memory used does not grow with the size of the groups. The older
+    lines are evicted as if they had left the window and their number is
+    added to evicted and, for the last slide, to truncated per group.
+
+    group, size and cost store the group being processed, the combination
+    size reached on it (0 for the rules, None once the group is completed)
+    and its estimated cost. The groups are processed from the cheapest (see
+    order_key) and resume is the (group, size, cost) from which the next
+    reconciliation must continue, skipping the groups sorted before group.
+
+    proposals is None when the matches are reconciled or the list of
+    (group, strategy, ids) proposed and not yet stored on run.
+    '''
+
+    def __init__(self, resume=None, digits=0, max_lines=None):
+        self.start = None
+        self.end = None
+        self.digits = digits
+        self.max_lines = max_lines
+        self.evicted = 0
+        self.truncated = {}
+        self.groups = {}
+        self.fresh = {}
+        self.changed = {}
+        self.group = None
+        self.size = None
+        self.cost = None
+        self.resume = resume
+        self.timed_out = False
+        self.proposals = None
+        self.run = None
+
+    def slide(self, start, end, lines):
+        '''
+        Move the window to [start, end]
+
+        The lines before start are evicted and lines, which must be the
+        (id, account, party, date, amount, key) of the lines entering the
+        window sorted by date on each group, are added. Return the number of
+        lines added.
+        '''
+        ordinal = start.toordinal()
+        self.changed = {}
+        self.truncated = {}
+        for group, group_lines in list(self.groups.items()):
+            self._changed(group, [x for x in group_lines if x[1] < ordinal])
+            group_lines = [x for x in group_lines if x[1] >= ordinal]
+            if group_lines:
+                self.groups[group] = group_lines
+            else:
+                del self.groups[group]
+        self.fresh = {}
+        factor = 10 ** self.digits
+        count = 0
+        for line in lines:
+            amount = line[4] * factor
+            if amount != int(amount):
+                # The amounts are scaled again so they stay exact
+                self._rescale(scale_amounts([line[4]], self.digits)[1])
+                factor = 10 ** self.digits
+                amount = line[4] * factor
+            group = line[1], line[2]
+            group_lines = self.groups.setdefault(group, [])
+            self.fresh.setdefault(group, len(group_lines))
+            group_lines.append((line[0], line[3].toordinal(), int(amount),
+                    line[5]))
+            count += 1
+            # Truncated once twice as large to not truncate on every line
+            if self.max_lines and len(group_lines) >= 2 * self.max_lines:
+                self._truncate(group)
+        if self.max_lines:
+            for group in self.fresh:
+                self._truncate(group)
+        for group in self.changed:
+            if group in self.groups:
+                self.fresh.setdefault(group, len(self.groups[group]))
+        self.start, self.end = start, end
+        return count
+
+    def _rescale(self, digits):
+        'Scale the amounts of the lines to more digits'
+        factor = 10 ** (digits - self.digits)
+        for group, group_lines in self.groups.items():
+            self.groups[group] = [(x[0], x[1], x[2] * factor, x[3])
+                for x in group_lines]
+        self.digits = digits
+
+    def _changed(self, group, lines):
+        'Store the keys of the lines leaving group'
+        keys = {x[3] for x in lines if x[3] is not None}
+        if keys:
+            self.changed.setdefault(group, set()).update(keys)
+
+    def _truncate(self, group):
+        'Evict the oldest lines of group beyond max_lines'
+        group_lines = self.groups[group]
+        excess = len(group_lines) - self.max_lines
+        if excess > 0:
+            self._changed(group, group_lines[:excess])
+            del group_lines[:excess]
+            self.fresh[group] = max(self.fresh[group] - excess, 0)
+            self.evicted += excess
+            self.truncated[group] = self.truncated.get(group, 0) + excess
+
+    @staticmethod
+    def group_key(group):
+        'The key to sort the groups'
+        account, party = group
+        return account, party or 0
+
+    @classmethod
+    def order_key(cls, group, cost):
+        'The key to process the groups from the cheapest'
+        return (cost,) + cls.group_key(group)
+
+    def discard(self, group, ids):
+        'Remove the lines of group with ids'
+        lines = self.groups.get(group, [])
+        fresh = self.fresh.get(group, len(lines))
+        self.fresh[group] = fresh - len(
+            [x for x in lines[:fresh] if x[0] in ids])
+        self.groups[group] = [x for x in lines if x[0] not in ids]
+
 
 class ReconcileMoves(Wizard):
     'Reconcile Moves'
@@ -98,160 +1303,967 @@ class ReconcileMoves(Wizard):
             ])
     reconcile = StateAction('account.act_move_line_form')
 
-    def reconciliation(self, start_date, end_date, timeout):
+    def reconciliation(self, start_date, end_date, scheduler, window=None,
+            statistics=None):
+        if window is None:
+            window = self._get_window()
+        if statistics is None:
+            statistics = ReconcileStatistics()
+        # Only the lines entering the window are fetched, the others are
+        # already on the window
+        fetch_date = start_date
+        if window.end is not None:
+            fetch_date = max(fetch_date, window.end + timedelta(days=1))
+
+        domain = self._get_lines_domain(fetch_date, end_date)
+        max_lines = int(self.start.max_lines)
+        # The groups deferred can not use the time of the next windows
+        share = scheduler.share()
+        buffer = ReconcileBuffer(statistics=statistics,
+            proposals=window.proposals, write_off=self.start.write_off)
+        reconciled = buffer.reconciled
+        # The lines from this date leave the window so their keys may have
+        # new matches
+        evict_date = start_date
+        if window.start is not None:
+            evict_date = min(window.start, start_date)
+
+        if self.start.use_references and fetch_date <= end_date:
+            # Each reference is matched without the lines matched by the
+            # previous ones
+            for reference in self.start.references or []:
+                with statistics.timer('search'):
+                    matches = list(self._reconcile_references_database(
+                            reference, start_date, end_date, fetch_date,
+                            self._store_proposals(window), evict_date))
+                for account, party, ids in matches:
+                    statistics.lines += len(ids)
+                    statistics.reference_matches += 1
+                    buffer.add(ids, (account, party), 'reference')
+                buffer.flush()
+                for account, party, ids in matches:
+                    window.discard((account, party), set(ids))
+
+        regexes = {}
+        if self.start.use_rules and fetch_date <= end_date:
+            # The lines of the accounts with rules supported by the database
+            # are matched by key before fetching them
+            accounts = self._get_database_rule_accounts()
+            with statistics.timer('search'):
+                matches = list(self._reconcile_rules_database(accounts,
+                        start_date, end_date, fetch_date,
+                        self._store_proposals(window), evict_date))
+            for account, party, ids in matches:
+                statistics.lines += len(ids)
+                statistics.rule_matches += 1
+                buffer.add(ids, (account, party), 'rule')
+            buffer.flush()
+            for account, party, ids in matches:
+                window.discard((account, party), set(ids))
+            for account in accounts:
+                regexes[account] = RuleExpressions([])
+
+        if (self.start.use_combinations and max_lines >= 2
+                and fetch_date <= end_date
+                and config.getboolean('account_reconcile', 'pair_matching',
+                    default=True)):
+            # Rules have precedence so the accounts with rules applied in
+            # Python are left to the window
+            excluded = set()
+            if self.start.use_rules:
+                excluded = (self._get_rule_accounts()
+                    - self._get_database_rule_accounts())
+            with statistics.timer('search'):
+                matches = list(self._reconcile_pairs_database(excluded,
+                        start_date, end_date, fetch_date,
+                        self._store_proposals(window)))
+            for account, party, ids in matches:
+                statistics.lines += len(ids)
+                statistics.combination_matches += 1
+                buffer.add(ids, (account, party), 'pair')
+            buffer.flush()
+            for account, party, ids in matches:
+                window.discard((account, party), set(ids))
+
+        lines = []
+        if fetch_date <= end_date:
+            lines = self._fetch_lines(domain, self._store_proposals(window))
+        if self.start.use_rules:
+            lines = ((x[0], x[1], x[2], x[3], x[4] - x[5],
+                    self._get_rule_key(regexes, x[1], x[6], statistics))
+                for x in lines)
+        else:
+            lines = ((x[0], x[1], x[2], x[3], x[4] - x[5], None)
+                for x in lines)
+        with statistics.timer('fetch'):
+            added = window.slide(start_date, end_date, lines)
+        for group, count in sorted(window.truncated.items(),
+                key=lambda x: window.group_key(x[0])):
+            logger.warning('Evicted %d lines of %s with more than %d lines',
+                count, group, window.max_lines)
+            statistics.evicted += count
+            statistics.notify('evict', account=group[0], party=group[1],
+                lines=count)
+        statistics.lines += added
+        statistics.notify('window', start_date=start_date,
+            end_date=end_date, lines=added)
+
+        # Only the groups that received or lost lines may have new matches,
+        # and those matches must include some of the new lines or, for the
+        # rules, the keys of the lines lost
+        resume, window.resume = window.resume, None
+        max_candidates = config.getint('account_reconcile', 'max_candidates',
+            default=MAX_CANDIDATES)
+        max_pairs = config.getint('account_reconcile', 'max_pairs',
+            default=MAX_PAIRS)
+        # The cheap groups, which are the most likely to match, are processed
+        # first
+        costs = {x: self._get_cost(len(window.groups[x]), max_lines,
+                max_candidates, max_pairs) for x in window.fresh}
+        groups = []
+        for group in sorted(window.fresh,
+                key=lambda x: window.order_key(x, costs[x])):
+            use_rules = self.start.use_rules
+            min_lines = 2
+            if resume:
+                # Skip what was already done by the run resumed. The groups
+                # done only lost lines so they are still sorted before.
+                resume_group, resume_size, resume_cost = resume
+                if group == resume_group:
+                    if resume_size is None:
+                        continue
+                    elif resume_size >= 2:
+                        use_rules = False
+                        min_lines = resume_size
+                elif (window.order_key(group, costs[group])
+                        < window.order_key(resume_group, resume_cost)):
+                    continue
+            groups.append((group, use_rules, min_lines))
+
+        # Groups exceeding their time slice are continued at the end, with
+        # the matcher keeping what was already searched
+        deferred = []
+        for count, (group, use_rules, min_lines) in enumerate(groups, 1):
+            window.group, window.size = group, 0
+            window.cost = costs[group]
+            if count % 10000 == 0:
+                logger.info('%d groups processed with %d lines reconciled'
+                    % (count, len(reconciled)))
+            if scheduler.expired():
+                logger.info('Timeout reached.')
+                window.timed_out = True
+                if deferred:
+                    window.group, window.size = deferred[0][:2]
+                    window.cost = costs[window.group]
+                self._notify_timeout(window, statistics)
+                return buffer.flush()
+            statistics.groups += 1
+            line_count = len(window.groups[group])
+            start_time = time.perf_counter()
+            statistics.notify('group', account=group[0], party=group[1],
+                lines=line_count, fresh=line_count - window.fresh[group])
+            if use_rules:
+                rule_matches = statistics.rule_matches
+                with statistics.timer('search'):
+                    lines = window.groups[group]
+                    fresh = window.fresh[group]
+                    keys = {x[3] for x in lines[fresh:] if x[3] is not None}
+                    keys |= window.changed.get(group, set())
+                    # key -> [amount, ids]
+                    numbers = {}
+                    for line in lines:
+                        if line[3] in keys:
+                            number = numbers.setdefault(line[3], [0, []])
+                            number[0] += line[2]
+                            number[1].append(line[0])
+                    for amount, ids in numbers.values():
+                        if len(ids) > 1 and amount == 0:
+                            statistics.rule_matches += 1
+                            buffer.add(ids, group, 'rule')
+                window.discard(group, reconciled)
+                statistics.notify('rules', account=group[0], party=group[1],
+                    matches=statistics.rule_matches - rule_matches,
+                    seconds=time.perf_counter() - start_time)
+            completed = True
+            # The combinations of the lines left were already searched
+            if (self.start.use_combinations
+                    and window.fresh[group] < len(window.groups[group])):
+                lines = window.groups[group]
+                if self.start.max_span is not None:
+                    # The fresh lines are dated after the others so they stay
+                    # at the end
+                    lines = sorted(lines, key=lambda x: x[1])
+                # Groups too large to search every size are downgraded
+                group_max_lines = max_size(len(lines), max_lines,
+                    max_candidates, max_pairs)
+                if group_max_lines < max_lines:
+                    candidates = sum(estimate_cost(len(lines), x, max_pairs)
+                        for x in range(2, max_lines + 1))
+                    logger.info('Searching combinations of %s up to %d '
+                        'lines, %d candidates estimated for %d lines',
+                        group, group_max_lines, candidates, len(lines))
+                    statistics.downgrade(group, len(lines), candidates,
+                        group_max_lines)
+                with statistics.timer('search'):
+                    # The amounts of the window are already scaled
+                    matcher = CombinationMatcher(
+                        [(x[0], x[2], x[1]) for x in lines],
+                        scheduler.slice(share, len(groups) - count + 1),
+                        fresh=window.fresh[group],
+                        span=self.start.max_span,
+                        tolerance=self._get_tolerance(window),
+                        max_pairs=max_pairs)
+                size = self._search_combinations(window, group, matcher,
+                    min_lines, group_max_lines, buffer, statistics)
+                if size is None:
+                    self._search_subsets(window, group, matcher.deadline,
+                        group_max_lines, buffer, statistics)
+                else:
+                    logger.info('Deferring %d lines of %s at size %d',
+                        len(matcher), group, size)
+                    deferred.append(
+                        (group, size, group_max_lines, matcher))
+                    completed = False
+            statistics.notify('group_end', account=group[0], party=group[1],
+                lines=line_count, seconds=time.perf_counter() - start_time,
+                completed=completed)
+            window.size = None
+
+        for index, (group, size, group_max_lines, matcher) in enumerate(
+                deferred):
+            window.group, window.size = group, size
+            window.cost = costs[group]
+            matcher.deadline = scheduler.slice(share, len(deferred) - index)
+            matcher.timed_out = False
+            start_time = time.perf_counter()
+            size = self._search_combinations(window, group, matcher, size,
+                group_max_lines, buffer, statistics)
+            if size is None:
+                self._search_subsets(window, group, matcher.deadline,
+                    group_max_lines, buffer, statistics)
+            statistics.notify('group_end', account=group[0], party=group[1],
+                lines=len(matcher), seconds=time.perf_counter() - start_time,
+                completed=size is None)
+            if size is not None and scheduler.expired():
+                logger.info('Timeout reached.')
+                window.timed_out = True
+                self._notify_timeout(window, statistics)
+                return buffer.flush()
+            elif size is not None:
+                # The share of the window is spent so the group is left to
+                # not delay the next windows
+                logger.info('Leaving %d lines of %s at size %d',
+                    len(matcher), group, size)
+                statistics.downgrade(group, len(matcher), costs[group],
+                    size - 1)
+            window.size = None
+        return buffer.flush()
+
+
+    def _get_cost(self, lines, max_lines, max_candidates, max_pairs):
+        '''
+        Return the candidates estimated to process a group of lines, one per
+        line plus the combinations searched up to max_lines
+        '''
+        cost = lines
+        if self.start.use_combinations:
+            size = max_size(lines, max_lines, max_candidates, max_pairs)
+            cost += sum(estimate_cost(lines, x, max_pairs)
+                for x in range(2, size + 1))
+        return cost
+
+    def _get_tolerance(self, window):
+        'Return the tolerance scaled as the amounts of window'
+        return int((self.start.tolerance or 0) * 10 ** window.digits)
+
+    def _notify_timeout(self, window, statistics):
+        account, party = window.group or (None, None)
+        statistics.notify('timeout', date=window.start, account=account,
+            party=party, size=window.size)
+
+    def _search_combinations(self, window, group, matcher, min_lines,
+            max_lines, buffer, statistics):
+        """
+        Search with matcher the combinations of group from min_lines to
+        max_lines lines. Return the size being searched if the matcher
+        deadline is reached or None once completed.
+        """
+        count = matcher.count
+        try:
+            for size in range(min_lines, max_lines + 1):
+                window.size = size
+                logger.info('Reconciling %d in %d batches'
+                    % (len(matcher), size))
+                statistics.notify('size_start', account=group[0],
+                    party=group[1], size=size, lines=len(matcher))
+                start_time = time.perf_counter()
+                candidates = matcher.count
+                matches = 0
+                with statistics.timer('search'):
+                    for ids in matcher.find(size):
+                        statistics.combination_matches += 1
+                        matches += 1
+                        buffer.add(ids, group, 'combination')
+                statistics.notify('size_end', account=group[0],
+                    party=group[1], size=size, matches=matches,
+                    candidates=matcher.count - candidates,
+                    seconds=time.perf_counter() - start_time,
+                    timed_out=matcher.timed_out)
+                if matcher.timed_out:
+                    return size
+        finally:
+            statistics.combinations += matcher.count - count
+            window.discard(group, buffer.reconciled)
+
+    def _search_subsets(self, window, group, deadline, min_lines, buffer,
+            statistics):
+        """
+        Search with SubsetSumMatcher the groups of group with more than
+        min_lines lines up to max_subset_lines until deadline.
+
+        The partial sums kept per line are limited by the
+        account_reconcile.subset_states configuration option.
+        """
+        max_lines = self.start.max_subset_lines or 0
+        if not self.start.use_subset_sum or max_lines <= min_lines:
+            return
+        lines = window.groups.get(group, [])
+        with statistics.timer('search'):
+            matcher = SubsetSumMatcher(
+                [(x[0], x[2], x[1]) for x in lines], deadline,
+                span=self.start.max_span,
+                tolerance=self._get_tolerance(window),
+                max_states=config.getint('account_reconcile',
+                    'subset_states', default=MAX_STATES))
+        start_time = time.perf_counter()
+        matches = 0
+        try:
+            with statistics.timer('search'):
+                for ids in matcher.find(max_lines):
+                    statistics.combination_matches += 1
+                    matches += 1
+                    buffer.add(ids, group, 'subset')
+        finally:
+            statistics.combinations += matcher.count
+            window.discard(group, buffer.reconciled)
+        statistics.notify('subsets', account=group[0], party=group[1],
+            lines=len(lines), matches=matches, skipped=matcher.skipped,
+            seconds=time.perf_counter() - start_time,
+            timed_out=matcher.timed_out)
+        if matcher.timed_out:
+            logger.info('Timeout reached searching the subsets of %s', group)
+
+    @classmethod
+    def run(cls, values):
+        '''
+        Reconcile using the values of the account.move_reconcile.start view
+        and return the ids of the lines reconciled
+        '''
+        session_id, _, _ = cls.create()
+        try:
+            wizard = cls(session_id)
+            for name, value in values.items():
+                setattr(wizard.start, name, value)
+            _, data = wizard.do_reconcile(None)
+        finally:
+            cls.delete(session_id)
+        return data.get('res_id', [])
+
+    def do_reconcile(self, action):
+        pool = Pool()
+        Run = pool.get('account.move_reconcile.run')
+        context = Transaction().context
+
+        if self.start.incremental and 'reconcile_since' not in context:
+            # Only the groups with lines changed since the last incremental
+            # run are reconciled. It is computed once for all the tasks and
+            # partitions.
+            since = Run.get_watermark(self.start.company.id)
+            with Transaction().set_context(reconcile_since=since):
+                return self.do_reconcile(action)
+
+        if self.start.background:
+            self.enqueue()
+            return
+
+        processes = config.getint('account_reconcile', 'processes',
+            default=1)
+        if processes > 1 and 'reconcile_partition' not in context:
+            self.reconcile_parallel(processes)
+            return
+
+        histogram = self._get_lines_histogram()
+        start_date = self.start.start_date
+        end_date = self.start.end_date
+        windows = []
+        if histogram:
+            start_date = start_date or histogram[0][0]
+            end_date = end_date or histogram[-1][0]
+            planner = ReconcilePlanner(histogram, self.start.max_days,
+                config.getint('account_reconcile', 'window_target',
+                    default=WINDOW_TARGET))
+            windows = list(planner.plan(start_date, end_date))
+        reconciled = []
+        window = self._get_window()
+        resumed = None
+        if context.get('reconcile_resume'):
+            resumed = Run(context['reconcile_resume'])
+            if resumed.checkpoint_group:
+                window.resume = (resumed.checkpoint_group,
+                    resumed.checkpoint_size, int(resumed.checkpoint_cost or 0))
+        statistics = ReconcileStatistics(self._get_listeners())
+        try:
+            run = Run.create_from_start(self.start)
+            if self.start.propose:
+                window.proposals = []
+                window.run = run
+            # The runs of a batch only record the watermark on the batch
+            if self.start.incremental and not context.get('reconcile_batch'):
+                run.watermark = self._get_watermark(run)
+            statistics.notify('start', run=run.id, company=run.company.id,
+                start_date=start_date, end_date=end_date)
+            checkpoint = None
+            logger.info('Starting moves reconciliation')
+            scheduler = ReconcileScheduler(self.start.timeout)
+            for index, (start, end) in enumerate(windows):
+                scheduler.windows = len(windows) - index
+                logger.info('Reconciling lines between %s and %s', start,
+                    end)
+                result = self.reconciliation(start, end, scheduler, window,
+                    statistics)
+                reconciled += result
+                logger.info('Reconciled %d lines', len(result))
+                if window.timed_out:
+                    checkpoint = (window.start, window.group, window.size,
+                    window.cost)
+                    break
+                if scheduler.expired() and index + 1 < len(windows):
+                    start = windows[index + 1][0]
+                    checkpoint = start, None, None, None
+                    statistics.notify('timeout', date=start, account=None,
+                        party=None, size=None)
+                    break
+            if window.proposals is not None:
+                logger.info('Finished. Proposed %d lines', len(reconciled))
+                self._store_proposals(window)
+                run.finish(statistics, 0, checkpoint)
+            else:
+                logger.info('Finished. Reconciled %d lines', len(reconciled))
+                run.finish(statistics, len(reconciled), checkpoint)
+            if run.batch and run.state == 'done':
+                Run.complete_batch(run.batch)
+            statistics.notify('end', run=run.id, state=run.state,
+                reconciled=len(reconciled), **statistics.values())
+        finally:
+            # The listeners, like the metrics file, are closed even if the
+            # run fails
+            statistics.close()
+        if (checkpoint and context.get('reconcile_continue')
+                and (not resumed
+                    or resumed.get_checkpoint() != run.get_checkpoint())):
+            # Continue on a new task unless the previous slice did not make
+            # any progress
+            Run.__queue__.resume([run])
+        data = {'res_id': reconciled}
+        return action, data
+
+    def _store_proposals(self, window):
+        '''
+        Store the proposals of window on its run and return if the lines of
+        the pending proposals must be skipped
+
+        The proposals are stored during the search, instead of once at the
+        end, so the matches made by the database skip the lines proposed.
+        '''
+        pool = Pool()
+        Proposal = pool.get('account.move_reconcile.proposal')
+        if window.proposals is None:
+            return False
+        if window.proposals:
+            Proposal.create_from_window(window.run, window.proposals)
+            # The list is shared with the buffers of the window
+            del window.proposals[:]
+        return True
+
+    def _get_lines_histogram(self):
+        '''
+        Return the sorted (date, count) of the lines to reconcile between the
+        dates of the wizard
+        '''
         pool = Pool()
         Line = pool.get('account.move.line')
-        ReconcileRule = pool.get('account.move_reconcile.rule')
+        Move = pool.get('account.move')
+        table = Line.__table__()
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+        domain = self._get_lines_domain(self.start.start_date,
+            self.start.end_date)
+        cursor.execute(*table.join(move, condition=table.move == move.id
+                ).select(move.date, Count(table.id),
+                where=self._get_lines_where(table, domain),
+                group_by=move.date,
+                order_by=move.date))
+        return [(date, count) for date, count in cursor]
+
+    def _get_window(self):
+        '''
+        Return a new window keeping at most account_reconcile.window_lines
+        lines per group
+        '''
+        return ReconcileWindow(digits=self.start.company.currency.digits,
+            max_lines=config.getint('account_reconcile', 'window_lines',
+                default=WINDOW_LINES))
+
+    def _get_watermark(self, run):
+        '''
+        Return the watermark of run, the lines created or modified after it
+        may not be seen by run
+
+        It is the start of the transaction, when run was created, minus the
+        account_reconcile.watermark_margin seconds. The lines written by the
+        transactions started before but committed after are stamped with
+        their own start so they are only seen by the next runs if those
+        transactions last less than the margin.
+        '''
+        margin = config.getint('account_reconcile', 'watermark_margin',
+            default=WATERMARK_MARGIN)
+        return run.create_date - timedelta(seconds=margin)
+
+    def _create_batch(self, tasks):
+        '''
+        Create the run of an incremental reconciliation split in tasks
+
+        It records the watermark of all the lines to reconcile and it is
+        done once all the tasks are done.
+        '''
+        pool = Pool()
+        Run = pool.get('account.move_reconcile.run')
+        run = Run.create_from_start(self.start)
+        run.batch = uuid4().hex
+        run.tasks = tasks
+        run.watermark = self._get_watermark(run)
+        if not tasks:
+            run.state = 'done'
+            run.end_time = datetime.now()
+        run.save()
+        return run
+
+    def _get_listeners(self):
+        '''
+        Return the listeners of the events of the reconciliation
+
+        The events are written as JSON lines to the file of the
+        account_reconcile.metrics configuration option if set.
+        '''
+        listeners = []
+        path = config.get('account_reconcile', 'metrics')
+        if path:
+            listeners.append(MetricsEmitter(path))
+        return listeners
+
+    def reconcile_parallel(self, processes):
+        '''
+        Split the account and party groups in processes partitions and
+        reconcile each one on a separate task of the queue with its own
+        transaction.
+        '''
+        pool = Pool()
+        Account = pool.get('account.account')
+        accounts = self._get_task_accounts()
+        values = self.start._default_values
+        values['background'] = False
+        context = {
+            'queue_name': 'account_reconcile',
+            }
+        if self.start.incremental:
+            batch = self._create_batch(processes)
+            context['reconcile_batch'] = batch.batch
+        for index in range(processes):
+            with Transaction().set_context(context,
+                    reconcile_partition=(index, processes)):
+                Account.__queue__.reconcile_moves(accounts, values)
+        logger.info('Enqueued reconciliation of %d partitions', processes)
+
+    def enqueue(self):
+        'Reconcile each account on a separate task of the queue'
+        pool = Pool()
+        Account = pool.get('account.account')
+
+        accounts = self._get_task_accounts()
+        values = self.start._default_values
+        values['background'] = False
+        context = {
+            'queue_name': 'account_reconcile',
+            }
+        if self.start.incremental:
+            batch = self._create_batch(len(accounts))
+            context['reconcile_batch'] = batch.batch
+        with Transaction().set_context(context):
+            for account in accounts:
+                Account.__queue__.reconcile_moves([account], values)
+        logger.info('Enqueued reconciliation of %d accounts', len(accounts))
+
+    def _get_task_accounts(self):
+        'Return the accounts selected or those with lines to reconcile'
+        pool = Pool()
+        Account = pool.get('account.account')
+        Line = pool.get('account.move.line')
         cursor = Transaction().connection.cursor()
         table = Line.__table__()
 
+        if self.start.accounts:
+            return list(self.start.accounts)
+        query = Line.search(self._get_lines_domain(
+                self.start.start_date, self.start.end_date), query=True)
+        cursor.execute(*table.select(table.account,
+                where=table.id.in_(query),
+                group_by=table.account,
+                order_by=table.account))
+        return Account.browse([a for a, in cursor])
+
+    def _get_lines_domain(self, start_date=None, end_date=None):
+        'Return the domain of the lines to reconcile between the dates'
         domain = [
             ('account.company', '=', self.start.company.id),
             ('account.reconcile', '=', True),
             ('reconciliation', '=', None),
-            ('date', '>=', start_date),
-            ('date', '<=', end_date),
             ]
-
+        if start_date:
+            domain.append(('date', '>=', start_date))
+        if end_date:
+            domain.append(('date', '<=', end_date))
         if self.start.accounts:
             domain.append(('account', 'in', self.start.accounts))
         if self.start.parties:
             domain.append(('party', 'in', self.start.parties))
+        return domain
 
-        max_lines = int(self.start.max_lines)
-        reconciled = set()
-
-        # Get grouped by account and party in order to not fetch all the moves
-        # in memory and only fetch the ones that can be reconciled.
-        query = Line.search(domain, query=True)
-        cursor.execute(*table.select(table.account, table.party,
-                where=(table.id.in_(query)),
-                group_by=(table.account, table.party)))
-
-        #currency = self.start.company.currency
-        for account, party in cursor.fetchall():
-            simple_domain = domain + [
-                ('account', '=', account),
-                ('party', '=', party),
-                ]
-            order = self._get_lines_order()
-            lines = Line.search(simple_domain, order=order)
-            if self.start.use_rules:
-                user_company = Transaction().context.get('company')
-                rules = ReconcileRule.search([
-                    ('account', '=', account),
-                    ('company', '=', user_company)
-                    ])
-                regexes = []
-                for rule in rules:
-                    try:
-                        regexes.append(re.compile(rule.expression))
-                    except:
-                        raise UserError(gettext(
-                            'account_reconcile.msg_wrong_expression',
-                            expression=rule.expression, rule=rule.id))
-                if regexes:
-                    numbers = {}
-                    count = 0
-                    for line in lines:
-                        count += 1
-                        if count % 10000 == 0:
-                            logger.info(
-                                '%d combinations processed' % count)
-                            if datetime.now() > timeout:
-                                logger.info('Timeout reached.')
-                                return list(reconciled)
-                        if line.description:
-                            for regex in regexes:
-                                match = regex.search(line.description)
-                                if match:
-                                    id = match.group(1).replace(' ', '')
-                                    numbers.setdefault(id, []).append(line)
-                                    break
-                    count = 0
-                    for lines in numbers.values():
-                        count += 1
-                        if count % 10000 == 0:
-                            logger.info(
-                                '%d combinations processed with %d lines '
-                                'reconciled' % (count, len(reconciled)))
-                            if datetime.now() > timeout:
-                                logger.info('Timeout reached.')
-                                return list(reconciled)
-                        if len(lines) > 1:
-                            amount = sum([x.debit - x.credit for x in lines])
-                            if amount == 0:
-                                Line.reconcile(lines)
-                                for line in lines:
-                                    reconciled.add(line.id)
-            if self.start.use_combinations:
-                lines = Line.search(simple_domain, order=order)
-                lines = [(x.id, x.debit - x.credit) for x in lines]
-                count = 0
-                for size in range(2, max_lines + 1):
-                    if datetime.now() > timeout:
-                        logger.info('Timeout reached.')
-                        return list(reconciled)
-                    logger.info(
-                        'Reconciling %d in %d batches' % (len(lines), size))
-                    for to_reconcile in combinations(lines, size):
-                        count += 1
-                        if count % 10000000 == 0:
-                            logger.info(
-                                '%d combinations processed with %d lines '
-                                'reconciled' % (count, len(reconciled)))
-                            if datetime.now() > timeout:
-                                logger.info('Timeout reached.')
-                                return list(reconciled)
-                        pending_amount = sum([x[1] for x in to_reconcile])
-                        if pending_amount == 0:
-                            ids = [x[0] for x in to_reconcile]
-                            if set(ids) & reconciled:
-                                continue
-                            Line.reconcile(Line.browse(ids))
-                            for line in to_reconcile:
-                                reconciled.add(line[0])
-                                lines.remove(line)
-        return list(reconciled)
+    def _fetch_lines(self, domain, proposed=False):
+        '''
+        Yield (id, account, party, date, debit, credit, description) for the
+        lines matching domain, except the ones of pending proposals if
+        proposed, sorted by account, party and _get_lines_order
 
-    def do_reconcile(self, action):
+        The rows are streamed by FETCH_SIZE, on PostgreSQL through a
+        server-side cursor.
+        If the context has a reconcile_partition (index, count), only the
+        groups of that partition are returned.
+        '''
         pool = Pool()
         Line = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        table = Line.__table__()
+        move = Move.__table__()
+        transaction = Transaction()
 
-        start_date = self.start.start_date
-        if not start_date:
-            lines = Line.search([], order=[('date', 'ASC')], limit=1)
-            if not lines:
-                return action, {}
-            start_date = lines[0].date
-        end_date = self.start.end_date
-        if not end_date:
-            lines = Line.search([], order=[('date', 'DESC')], limit=1)
-            if not lines:
-                return action, {}
-            end_date = lines[0].date
-        start = start_date
-        reconciled = []
-        logger.info('Starting moves reconciliation')
-        timeout = datetime.now() + self.start.timeout
-        while start <= end_date and start_date and end_date:
-            end = start + relativedelta(days=self.start.max_days)
-            if end > end_date:
-                end = end_date
-            logger.info('Reconciling lines between %s and %s', start,
-                end)
-            result = self.reconciliation(start, end, timeout)
-            reconciled += result
-            logger.info('Reconciled %d lines', len(result))
-            if datetime.now() > timeout:
-                break
-            start += relativedelta(days=max(1, self.start.max_days // 2))
-        logger.info('Finished. Reconciled %d lines', len(reconciled))
-        data = {'res_id': reconciled}
-        return action, data
+        # The effective date of a line is the one of its move
+        columns = {
+            'date': move.date,
+            }
+        order_by = [table.account, table.party]
+        for fname, direction in self._get_lines_order():
+            column = columns.get(fname, Column(table, fname))
+            order_by.append(Desc(column) if direction == 'DESC'
+                else Asc(column))
+        order_by.append(table.id)
+        query = table.join(move, condition=table.move == move.id).select(
+            table.id, table.account, table.party, move.date, table.debit,
+            table.credit, table.description,
+            where=self._get_lines_where(table, domain, proposed),
+            order_by=order_by)
+        if backend.name == 'postgresql':
+            cursor = transaction.connection.cursor('account_reconcile_lines')
+            cursor.itersize = FETCH_SIZE
+            try:
+                cursor.execute(*query)
+                yield from cursor
+            finally:
+                cursor.close()
+        else:
+            cursor = transaction.connection.cursor()
+            cursor.execute(*query)
+            while True:
+                rows = cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                yield from rows
+
+    def _get_lines_where(self, table, domain, proposed=False):
+        """
+        Return the condition on the line table for the lines matching domain,
+        not in a pending proposal if proposed, and the reconcile_partition of
+        the context
+
+        If the context has a reconcile_since time, only the lines of the
+        groups with some pending line created or modified after it match.
+        """
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Proposal = pool.get('account.move_reconcile.proposal')
+        context = Transaction().context
+        where = table.id.in_(Line.search(domain, query=True))
+        if proposed:
+            where &= ~Proposal.get_pending_where(table)
+        if context.get('reconcile_since'):
+            changed = Line.__table__()
+            where &= Exists(changed.select(changed.id,
+                    where=((changed.account == table.account)
+                        & (Coalesce(changed.party, 0)
+                            == Coalesce(table.party, 0))
+                        & (changed.reconciliation == Null)
+                        & (Coalesce(changed.write_date, changed.create_date)
+                            > context['reconcile_since']))))
+        partition = context.get('reconcile_partition')
+        if partition:
+            index, count = partition
+            where &= ((table.account + Coalesce(table.party, 0)) % count
+                == index)
+        return where
+
+    def _get_rule_accounts(self):
+        'Return the accounts with reconcile rules'
+        pool = Pool()
+        ReconcileRule = pool.get('account.move_reconcile.rule')
+        user_company = Transaction().context.get('company')
+        rules = ReconcileRule.search([
+                ('company', '=', user_company),
+                ])
+        return {r.account.id for r in rules}
+
+    def _get_database_rule_accounts(self):
+        """
+        Return the accounts whose rules can be applied by the database
+
+        Only PostgreSQL is supported and it can be disabled with the
+        account_reconcile.database_rules configuration option.
+        """
+        pool = Pool()
+        ReconcileRule = pool.get('account.move_reconcile.rule')
+        if (backend.name != 'postgresql'
+                or not config.getboolean('account_reconcile',
+                    'database_rules', default=True)):
+            return set()
+        user_company = Transaction().context.get('company')
+        return {a for a in self._get_rule_accounts()
+            if ReconcileRule.get_expressions(user_company, a).portable}
+
+    def _reconcile_rules_database(self, accounts, start_date, end_date,
+            fetch_date, proposed=False, evict_date=None):
+        """
+        Yield (account, party, ids) of the lines of accounts between the
+        dates that share a rule key and whose amounts sum to zero.
+
+        The keys are extracted by the database with the first rule that
+        matches. Like the rules applied on the window, only the keys of some
+        line dated from fetch_date or leaving the window, dated from
+        evict_date, are returned (see _get_key_groups).
+        """
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        ReconcileRule = pool.get('account.move_reconcile.rule')
+        table = Line.__table__()
+        move = Move.__table__()
+        rule = ReconcileRule.__table__()
+        cursor = Transaction().connection.cursor()
+        user_company = Transaction().context.get('company')
+
+        if not accounts:
+            return
+        match = Substring(table.description, rule.expression)
+        key = rule.select(Replace(match, ' ', ''),
+            where=((rule.account == table.account)
+                & (rule.company == user_company)
+                & (match != Null)),
+            order_by=[rule.id.asc],
+            limit=1)
+        domain = self._get_lines_domain(evict_date or start_date, end_date)
+        keyed = With('id', 'account', 'party', 'date', 'amount', 'key',
+            query=table.join(move, condition=table.move == move.id).select(
+                table.id, table.account, Coalesce(table.party, 0),
+                move.date, table.debit - table.credit, key,
+                where=(self._get_lines_where(table, domain, proposed)
+                    & table.account.in_(list(accounts))
+                    & (table.description != Null))))
+        groups = self._get_key_groups(keyed, start_date, fetch_date)
+        query = keyed.join(groups, condition=(
+                (keyed.account == groups.account)
+                & (keyed.party == groups.party)
+                & (keyed.key == groups.key))
+            ).select(keyed.account, keyed.party, ArrayAgg(keyed.id),
+                where=keyed.date >= start_date,
+                group_by=[keyed.account, keyed.party, keyed.key],
+                order_by=[keyed.account, keyed.party, Min(keyed.id)],
+                with_=[keyed])
+        cursor.execute(*query)
+        for account, party, ids in cursor:
+            yield account, party or None, sorted(ids)
+
+    def _get_key_groups(self, keyed, start_date, fetch_date):
+        """
+        Return the (account, party, key) of the keyed lines whose lines from
+        start_date sum to zero
+
+        Only the groups with some line dated from fetch_date, which enters
+        the window, or before start_date, which leaves it, can have new
+        matches. The other ones were already matched on the previous window.
+        """
+        in_window = keyed.date >= start_date
+        return keyed.select(keyed.account, keyed.party, keyed.key,
+            where=keyed.key != Null,
+            group_by=[keyed.account, keyed.party, keyed.key],
+            having=((Sum(Case((in_window, keyed.amount), else_=0)) == 0)
+                & (Count(keyed.id, filter_=in_window) > 1)
+                & ((Max(keyed.date) >= fetch_date)
+                    | (Min(keyed.date) < start_date))))
+
+    def _get_reference_columns(self, table, move):
+        '''
+        Return the column of each reference of get_references for the line
+        table joined with its move
+        '''
+        return {
+            'move_origin': move.origin,
+            'line_origin': table.origin,
+            'move_description': move.description,
+            }
+
+    def _reconcile_references_database(self, reference, start_date,
+            end_date, fetch_date, proposed=False, evict_date=None):
+        """
+        Yield (account, party, ids) of the lines between the dates that share
+        the reference and whose amounts sum to zero.
+
+        The lines are grouped by account, party and reference in the
+        database. Like the rules applied on the window, only the groups with
+        some line dated from fetch_date or leaving the window, dated from
+        evict_date, are returned (see _get_key_groups).
+        """
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        table = Line.__table__()
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        domain = self._get_lines_domain(evict_date or start_date, end_date)
+        key = self._get_reference_columns(table, move)[reference]
+        keyed = With('id', 'account', 'party', 'date', 'amount', 'key',
+            query=table.join(move, condition=table.move == move.id).select(
+                table.id, table.account, Coalesce(table.party, 0),
+                move.date, table.debit - table.credit, key,
+                where=(self._get_lines_where(table, domain, proposed)
+                    & (key != Null))))
+        groups = self._get_key_groups(keyed, start_date, fetch_date)
+        query = keyed.join(groups, condition=(
+                (keyed.account == groups.account)
+                & (keyed.party == groups.party)
+                & (keyed.key == groups.key))
+            ).select(keyed.account, keyed.party, keyed.key, keyed.id,
+                where=keyed.date >= start_date,
+                order_by=[keyed.account, keyed.party, keyed.key, keyed.id],
+                with_=[keyed])
+        cursor.execute(*query)
+        for (account, party, _), rows in groupby(cursor,
+                key=lambda x: x[:3]):
+            yield account, party or None, [x[3] for x in rows]
+
+    def _reconcile_pairs_database(self, excluded, start_date, end_date,
+            fetch_date, proposed=False):
+        """
+        Yield (account, party, ids) of the pairs of lines between the dates,
+        not in excluded accounts, with opposite amounts.
+
+        For each account, party and amount, the n-th debit is paired with the
+        n-th credit sorted by date which minimizes the days between the lines
+        of the pairs. The pairs of lines more than max_days, or max_span,
+        apart are skipped and at least one line must be dated from
+        fetch_date, like the combinations searched on the window.
+        """
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Move = pool.get('account.move')
+        table = Line.__table__()
+        move = Move.__table__()
+        debit = Line.__table__()
+        credit = Line.__table__()
+        debit_move = Move.__table__()
+        credit_move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        domain = self._get_lines_domain(start_date, end_date)
+        where = self._get_lines_where(table, domain, proposed)
+        if excluded:
+            where &= ~table.account.in_(list(excluded))
+        amount = table.debit - table.credit
+        party = Coalesce(table.party, 0)
+        ranked = table.join(move, condition=table.move == move.id).select(
+            table.id, table.account, party.as_('party'),
+            amount.as_('amount'),
+            RowNumber(window=Window([table.account, party, amount],
+                    order_by=[move.date.asc, table.id.asc])).as_('rank'),
+            where=where & (amount != 0))
+        debits = ranked.select(where=ranked.amount > 0)
+        credits = ranked.select(where=ranked.amount < 0)
+        query = (debits
+            .join(credits, condition=(
+                    (debits.account == credits.account)
+                    & (debits.party == credits.party)
+                    & (debits.amount == -credits.amount)
+                    & (debits.rank == credits.rank)))
+            .join(debit, condition=debit.id == debits.id)
+            .join(debit_move, condition=debit.move == debit_move.id)
+            .join(credit, condition=credit.id == credits.id)
+            .join(credit_move, condition=credit.move == credit_move.id)
+            .select(debit.account, debit.party, debit.id, credit.id,
+                debit_move.date, credit_move.date,
+                where=((debit_move.date >= fetch_date)
+                    | (credit_move.date >= fetch_date)),
+                order_by=[debit.account, debits.party, debit_move.date,
+                    debit.id]))
+        cursor.execute(*query)
+        max_days = self.start.max_days
+        if self.start.max_span is not None:
+            max_days = min(max_days, self.start.max_span)
+        max_days = timedelta(days=max_days)
+        for account, party, debit_id, credit_id, debit_date, credit_date in (
+                cursor):
+            if abs(debit_date - credit_date) <= max_days:
+                yield account, party, sorted([debit_id, credit_id])
+
+    def _get_rule_regexes(self, account):
+        'Return the compiled expressions of the rules of account'
+        pool = Pool()
+        ReconcileRule = pool.get('account.move_reconcile.rule')
+        user_company = Transaction().context.get('company')
+        return ReconcileRule.get_expressions(user_company, account)
+
+    def _get_rule_key(self, regexes, account, description, statistics=None):
+        '''
+        Return the key extracted from description by the first matching rule
+        of account. regexes is used as cache of the rules per account.
+        '''
+        if account not in regexes:
+            regexes[account] = self._get_rule_regexes(account)
+        if description and regexes[account]:
+            if statistics is None:
+                statistics = ReconcileStatistics()
+            with statistics.timer('regex'):
+                return regexes[account].key(description)
 
     def _get_lines_order(self):
         'Return the order on which the lines to reconcile will be returned'
         return [
             ('date', 'ASC')
             ]
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.append(
+            ('account.move_reconcile.run|reconcile_incremental',
+                "Reconcile Moves Incrementally"))
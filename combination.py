@@ -0,0 +1,575 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from decimal import Decimal
+import logging
+from math import comb
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+# Number of evaluated candidates between two deadline checks
+CHECK_INTERVAL = 1000
+# Number of evaluated candidates between two progress logs
+LOG_INTERVAL = 10000000
+# Default maximum number of partial sums kept by SubsetSumMatcher
+MAX_STATES = 1000000
+# Default maximum number of pairs in the table of pair sums of
+# CombinationMatcher
+MAX_PAIRS = 1000000
+
+
+def scale_amounts(amounts, digits=0):
+    '''
+    Return amounts as an array of integers and the digits used to scale them
+
+    digits is increased if some amount has more decimals so the integers
+    always represent the amounts exactly.
+    '''
+    for amount in amounts:
+        if isinstance(amount, Decimal):
+            digits = max(digits, -amount.normalize().as_tuple().exponent)
+    factor = 10 ** digits
+    return array('q', (int(x * factor) for x in amounts)), digits
+
+
+def estimate_cost(lines, size, max_pairs=MAX_PAIRS):
+    '''
+    Return the number of candidates CombinationMatcher evaluates at most to
+    search the combinations of size among lines
+
+    Without the table of pair sums, when it would hold more than max_pairs
+    pairs, the pairs are scanned like for three lines.
+    '''
+    if size < 2 or lines < size:
+        return 0
+    elif size == 2:
+        return lines
+    elif size == 3:
+        return lines * lines
+    elif comb(lines, 2) > max_pairs:
+        return comb(lines, size - 2) * lines
+    return comb(lines, size - 2) + comb(lines, 2)
+
+
+def max_size(lines, max_lines, max_cost, max_pairs=MAX_PAIRS):
+    '''
+    Return the largest size up to max_lines for which searching the
+    combinations of every size among lines costs at most max_cost
+    '''
+    cost = 0
+    for size in range(2, max_lines + 1):
+        cost += estimate_cost(lines, size, max_pairs)
+        if cost > max_cost:
+            return size - 1
+    return max_lines
+
+
+class Matcher(object):
+    'Count the candidates evaluated by a search and check its deadline'
+
+    def __init__(self, deadline=None):
+        self.deadline = deadline
+        self.timed_out = False
+        self.count = 0
+
+    def _tick(self, count=1):
+        previous = self.count
+        self.count += count
+        if self.count // CHECK_INTERVAL != previous // CHECK_INTERVAL:
+            if self.count // LOG_INTERVAL != previous // LOG_INTERVAL:
+                logger.info('%d combinations processed', self.count)
+            if self.deadline and time.monotonic() > self.deadline:
+                self.timed_out = True
+        return self.timed_out
+
+
+class CombinationMatcher(Matcher):
+    '''
+    Find disjoint groups of lines whose amounts sum to zero.
+
+    Lines are given as (id, amount) tuples in the order they must be
+    considered. Groups are returned in the same order itertools.combinations
+    would return them, skipping the ones that include an already matched
+    line, but the search relies on an amount index instead of summing every
+    combination:
+
+    - pairs are found with a hash lookup of the opposite amount
+    - for three lines the first one is fixed and the complementary pair is
+      found with hash lookups
+    - for four or more lines the first ones are fixed and the complementary
+      pair is found on a table of pair sums built once per group, or like
+      for three lines if the table would hold more than max_pairs pairs
+    - partial combinations that can no longer sum to zero are pruned using
+      the smallest and largest amounts after the last fixed line, so for
+      example lines of the same sign are not combined once the remaining
+      lines can not compensate them
+
+    If fresh is given, lines before that position are known not to have any
+    zero sum combination among them, so only combinations including some
+    line from fresh onwards are searched.
+
+    If span is given, lines are (id, amount, date) tuples sorted by date,
+    with the date as an ordinal, and only the combinations whose dates differ
+    at most span are searched. The lines within the span of each one are
+    found with a sliding window so the others are never visited and the
+    table of pair sums only holds the pairs within the span.
+
+    If tolerance is given, the groups whose amounts sum at most tolerance
+    away from zero are also returned once the exact groups of the same size
+    are found. The complementary amounts are then searched as ranges on the
+    sorted amounts and pair sums.
+
+    Amounts are converted once to integers scaled by digits (see
+    scale_amounts) and kept in arrays parallel to the ids. If numpy is
+    available the pair sums are computed and sorted in a single vectorized
+    operation.
+    '''
+
+    def __init__(self, lines, deadline=None, digits=0, fresh=0, span=None,
+            tolerance=0, max_pairs=MAX_PAIRS):
+        super().__init__(deadline)
+        self.ids = array('q', (x[0] for x in lines))
+        self.amounts, self.digits = scale_amounts([x[1] for x in lines],
+            digits)
+        self.tolerance = int(tolerance * 10 ** self.digits)
+        self.active = bytearray(b'\x01' * len(self.ids))
+        self.fresh = fresh
+        # amount -> sorted positions of the active lines with that amount
+        self.index = {}
+        for position, amount in enumerate(self.amounts):
+            self.index.setdefault(amount, []).append(position)
+        self.keys = sorted(self.index)
+        # Pairs of positions sorted by sum and positions, built on demand. It
+        # is a tuple of numpy arrays (sums, firsts, seconds) if numpy is
+        # available and a dict sum -> [(first, second)] otherwise
+        self.pairs = None
+        self.pair_keys = None
+        self.max_pairs = max_pairs
+        # The table of pair sums would hold more than max_pairs pairs
+        self.scan_pairs = False
+        # Smallest and largest amounts from each position, see _build_bounds
+        self.lowest = self.highest = None
+        # Position after the last line within span of each position
+        self.limit = None
+        if span is not None:
+            dates = [x[2] for x in lines]
+            self.limit = array('q')
+            end = 0
+            for date in dates:
+                while end < len(dates) and dates[end] - date <= span:
+                    end += 1
+                self.limit.append(end)
+
+    def __len__(self):
+        return sum(self.active)
+
+    def find(self, size):
+        'Yield the ids of each group of size lines that sum to zero'
+        if size < 2:
+            return
+        if size > 3 and self.pairs is None and not self.scan_pairs:
+            self._build_pairs()
+        if size > 2:
+            self._build_bounds(size)
+        tolerance = self.tolerance
+        try:
+            # Exact groups are searched first so a group within the tolerance
+            # can not take the lines of an exact one
+            for self.tolerance in sorted({0, tolerance}):
+                yield from self._find(size)
+        finally:
+            self.tolerance = tolerance
+
+    def _find(self, size):
+        start = 0
+        while not self.timed_out:
+            match = self._search(size, start, [], 0)
+            if not match:
+                break
+            self._consume(match)
+            yield [self.ids[x] for x in match]
+            # Consuming lines can not create new matches so there is no need
+            # to look again at combinations starting before this one.
+            start = match[0]
+
+    def _end(self, first):
+        'Return the position after the last line that can follow first'
+        if self.limit is None:
+            return len(self.ids)
+        return self.limit[first]
+
+    def _search(self, size, start, chosen, total):
+        # The first line is the earliest so it bounds the following ones
+        end = self._end(chosen[0]) if chosen else len(self.ids)
+        if len(chosen) == size - 2:
+            after = chosen[-1] if chosen else start - 1
+            pair = self._find_pair(-total, after, end)
+            if pair:
+                return chosen + list(pair)
+            return
+        remaining = size - len(chosen) - 1
+        for position in range(start, end):
+            if not self.active[position]:
+                continue
+            if self._tick():
+                return
+            subtotal = total + self.amounts[position]
+            if self._prune(subtotal, remaining, position + 1):
+                continue
+            match = self._search(size, position + 1, chosen + [position],
+                subtotal)
+            if match or self.timed_out:
+                return match
+
+    def _build_bounds(self, size):
+        # The size - 1 smallest and largest amounts of the active lines from
+        # each position, sorted from the most extreme
+        count = size - 1
+        self.lowest = [()] * (len(self.amounts) + 1)
+        self.highest = [()] * (len(self.amounts) + 1)
+        for position in range(len(self.amounts) - 1, -1, -1):
+            lowest = self.lowest[position + 1]
+            highest = self.highest[position + 1]
+            if self.active[position]:
+                amount = self.amounts[position]
+                if len(lowest) < count or amount < lowest[-1]:
+                    lowest = list(lowest)
+                    insort(lowest, amount)
+                    lowest = tuple(lowest[:count])
+                if len(highest) < count or -amount < highest[-1]:
+                    highest = list(highest)
+                    insort(highest, -amount)
+                    highest = tuple(highest[:count])
+            self.lowest[position] = lowest
+            self.highest[position] = highest
+
+    def _prune(self, total, remaining, start):
+        """
+        Return if remaining more lines from start can not sum -total
+
+        Lines consumed after the bounds were built only make the bounds
+        looser so they are still valid.
+        """
+        lowest = self.lowest[start]
+        if len(lowest) < remaining:
+            return True
+        return (total + sum(lowest[:remaining]) > self.tolerance
+            or total - sum(self.highest[start][:remaining])
+            < -self.tolerance)
+
+    def _within(self, keys, target):
+        'Return the sorted keys within the tolerance of target'
+        if not self.tolerance:
+            return [target]
+        lower = bisect_left(keys, target - self.tolerance)
+        upper = bisect_right(keys, target + self.tolerance)
+        return keys[lower:upper]
+
+    def _find_pair(self, target, after, end):
+        '''
+        Return the first pair of active positions after after and before end
+        summing target, within the tolerance
+        '''
+        if self.pairs is not None and numpy and self.tolerance:
+            sums, firsts, seconds = self.pairs
+            lower = numpy.searchsorted(sums, target - self.tolerance, 'left')
+            upper = numpy.searchsorted(sums, target + self.tolerance,
+                'right')
+            if self._tick(upper - lower):
+                return
+            # The pairs of different sums are not sorted by positions
+            firsts, seconds = firsts[lower:upper], seconds[lower:upper]
+            active = numpy.frombuffer(self.active, dtype=numpy.uint8)
+            mask = ((firsts > after) & (seconds < end)
+                & (active[firsts] == 1) & (active[seconds] == 1))
+            if mask.any():
+                firsts, seconds = firsts[mask], seconds[mask]
+                best = numpy.lexsort((seconds, firsts))[0]
+                return int(firsts[best]), int(seconds[best])
+            return
+        elif self.pairs is not None and numpy:
+            sums, firsts, seconds = self.pairs
+            lower = numpy.searchsorted(sums, target, 'left')
+            upper = numpy.searchsorted(sums, target, 'right')
+            lower += numpy.searchsorted(firsts[lower:upper], after + 1)
+            for first, second in zip(firsts[lower:upper].tolist(),
+                    seconds[lower:upper].tolist()):
+                if self._tick():
+                    return
+                if (second < end
+                        and self.active[first] and self.active[second]):
+                    return first, second
+            return
+        elif self.pairs is not None:
+            best = None
+            for key in self._within(self.pair_keys, target):
+                candidates = self.pairs.get(key, [])
+                first = bisect_left(candidates, (after + 1,))
+                for pair in candidates[first:]:
+                    if self._tick():
+                        return
+                    if best is not None and pair > best:
+                        break
+                    if (pair[1] < end and self.active[pair[0]]
+                            and self.active[pair[1]]):
+                        best = pair
+                        break
+            return best
+        for position in range(after + 1, end):
+            if not self.active[position]:
+                continue
+            if self._tick():
+                return
+            # The last line of the combination must be a fresh one
+            other = self._find_other(target - self.amounts[position],
+                max(position, self.fresh - 1), min(end, self._end(position)))
+            if other is not None:
+                return position, other
+
+    def _find_other(self, target, after, end):
+        '''
+        Return the first active position after after and before end with an
+        amount within the tolerance of target
+        '''
+        best = None
+        for amount in self._within(self.keys, target):
+            candidates = self.index.get(amount)
+            if not candidates:
+                continue
+            other = bisect_right(candidates, after)
+            if (other < len(candidates) and candidates[other] < end
+                    and (best is None or candidates[other] < best)):
+                best = candidates[other]
+        return best
+
+    def _build_pairs(self):
+        positions = [x for x, active in enumerate(self.active) if active]
+        # The pair holds the last line of the combination which must be a
+        # fresh one
+        fresh = bisect_left(positions, self.fresh)
+        count = sum(
+            max(bisect_left(positions, self._end(first)) - max(i + 1, fresh),
+                0)
+            for i, first in enumerate(positions))
+        if count > self.max_pairs:
+            logger.info('Scanning the pairs of %d lines instead of a table '
+                'of %d pair sums', len(positions), count)
+            self.scan_pairs = True
+            return
+        if numpy:
+            if self._tick(count):
+                return
+            positions = numpy.array(positions, dtype=numpy.int64)
+            amounts = numpy.frombuffer(self.amounts, dtype=numpy.int64)
+            # Only the indexes of the pairs kept are built: the seconds of
+            # each first are the fresh positions after it within its span
+            starts = numpy.maximum(
+                numpy.arange(1, len(positions) + 1), fresh)
+            if self.limit is None:
+                ends = numpy.full(len(positions), len(positions))
+            else:
+                limit = numpy.frombuffer(self.limit, dtype=numpy.int64)
+                ends = numpy.searchsorted(positions, limit[positions], 'left')
+            counts = numpy.maximum(ends - starts, 0)
+            firsts = numpy.repeat(numpy.arange(len(positions)), counts)
+            seconds = (numpy.arange(count)
+                - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+                + numpy.repeat(starts, counts))
+            firsts, seconds = positions[firsts], positions[seconds]
+            sums = amounts[firsts] + amounts[seconds]
+            # Pairs are generated sorted by positions so a stable sort keeps
+            # that order among pairs with the same sum
+            order = numpy.argsort(sums, kind='stable')
+            self.pairs = sums[order], firsts[order], seconds[order]
+            return
+        # The table is only kept once complete so it is built again if the
+        # deadline is reached
+        pairs = {}
+        for i, first in enumerate(positions):
+            amount = self.amounts[first]
+            if self._tick(len(positions) - i):
+                return
+            end = bisect_left(positions, self._end(first))
+            for second in positions[max(i + 1, fresh):end]:
+                pairs.setdefault(amount + self.amounts[second],
+                    []).append((first, second))
+        self.pairs = pairs
+        self.pair_keys = sorted(pairs)
+
+    def _consume(self, positions):
+        for position in positions:
+            self.active[position] = 0
+            self.index[self.amounts[position]].remove(position)
+
+
+class SubsetSumMatcher(Matcher):
+    '''
+    Find disjoint groups of one line and several lines of the opposite sign
+    whose amounts sum to zero, like a payment of many invoices.
+
+    Lines are given as (id, amount, date) tuples, with the date as an
+    ordinal, in the order they must be considered. For each line, the
+    amounts reachable by the lines of the opposite sign are computed with a
+    dynamic programming over integer amounts (see scale_amounts):
+
+    - a dictionary per number of lines maps each partial sum to the last
+      line added and the previous partial sum, so one subset can be
+      reconstructed once the amount of the line is reached
+    - partial sums beyond the amount of the line, plus the tolerance, are
+      discarded as the amounts of the opposite sign only increase them
+    - at most max_states partial sums are kept for a line, the lines
+      exceeding it are skipped
+
+    The positions of each sign are sorted by date once so a line only scans
+    the lines of the opposite sign within the span.
+
+    If span is given, the dates of the lines of a group differ at most span
+    days. The subsets are searched on each interval of span days that
+    includes the line compensated, starting at its date or at the date of an
+    earlier line of the opposite sign. If tolerance is given, the groups
+    whose amounts sum at most tolerance away from zero are also returned.
+    '''
+
+    def __init__(self, lines, deadline=None, digits=0, span=None,
+            tolerance=0, max_states=MAX_STATES):
+        super().__init__(deadline)
+        self.ids = array('q', (x[0] for x in lines))
+        self.amounts, self.digits = scale_amounts([x[1] for x in lines],
+            digits)
+        self.dates = array('q', (x[2] for x in lines))
+        self.span = span
+        self.tolerance = int(tolerance * 10 ** self.digits)
+        self.max_states = max_states
+        self.active = bytearray(b'\x01' * len(self.ids))
+        # sign -> positions with an amount of that sign and their dates
+        self.positions = {1: array('q'), -1: array('q')}
+        self.position_dates = {1: array('q'), -1: array('q')}
+        for position in sorted(range(len(self.ids)),
+                key=self.dates.__getitem__):
+            amount = self.amounts[position]
+            if amount:
+                sign = 1 if amount > 0 else -1
+                self.positions[sign].append(position)
+                self.position_dates[sign].append(self.dates[position])
+        # Lines before this position do not have any group
+        self.start = 0
+        # Number of lines skipped for exceeding max_states
+        self.skipped = 0
+
+    def __len__(self):
+        return sum(self.active)
+
+    def find(self, max_lines):
+        'Yield the ids of each group of up to max_lines lines that sum zero'
+        if max_lines < 2:
+            return
+        while self.start < len(self.ids):
+            position = self.start
+            if self.active[position]:
+                match = self._search(position, max_lines)
+                if self.timed_out:
+                    return
+                if match:
+                    for other in match:
+                        self.active[other] = 0
+                    yield [self.ids[x] for x in match]
+            # Consuming lines can not create new groups for the previous
+            # lines
+            self.start += 1
+
+    def _intervals(self, position, sign):
+        'Yield the (first, last) dates of the intervals to search'
+        if self.span is None:
+            yield None, None
+            return
+        date = self.dates[position]
+        dates = self.position_dates[sign]
+        lower = bisect_left(dates, date - self.span)
+        upper = bisect_right(dates, date)
+        for first in sorted(set(dates[lower:upper]) | {date}):
+            yield first, first + self.span
+
+    def _candidates(self, sign, first, last):
+        'Yield the active positions of sign dated between first and last'
+        positions = self.positions[sign]
+        lower, upper = 0, len(positions)
+        if first is not None:
+            dates = self.position_dates[sign]
+            lower = bisect_left(dates, first)
+            upper = bisect_right(dates, last)
+        for index in range(lower, upper):
+            if self._tick():
+                return
+            other = positions[index]
+            if self.active[other]:
+                yield other
+
+    def _search(self, position, max_lines):
+        '''
+        Return the sorted positions of a group with position and lines of
+        the opposite sign summing zero within the tolerance
+        '''
+        target = -self.amounts[position]
+        if not target:
+            return
+        sign = 1 if target > 0 else -1
+        for first, last in self._intervals(position, sign):
+            if self.timed_out:
+                return
+            match = self._search_interval(position, sign, target * sign,
+                max_lines, first, last)
+            if match is not None:
+                return match or None
+
+    def _search_interval(self, position, sign, target, max_lines, first,
+            last):
+        '''
+        Return the group of position with lines dated between first and last
+        or None if there is none. Return an empty list if max_states is
+        exceeded.
+        '''
+        bound = target + self.tolerance
+        # layers[k] maps the sums of k lines to (last position, previous sum)
+        layers = [{0: None}]
+        states = 0
+        for other in self._candidates(sign, first, last):
+            amount = self.amounts[other] * sign
+            if amount > bound:
+                continue
+            if self._tick(sum(len(x) for x in layers)):
+                return
+            # From the largest subsets so the line is only added once
+            for size in range(min(len(layers), max_lines - 1) - 1, -1, -1):
+                if size + 1 == len(layers):
+                    layers.append({})
+                following = layers[size + 1]
+                for total in layers[size]:
+                    total += amount
+                    if total > bound or total in following:
+                        continue
+                    following[total] = (other, total - amount)
+                    if abs(total - target) <= self.tolerance:
+                        return self._reconstruct(position, layers, size + 1,
+                            total)
+                    states += 1
+                if states > self.max_states:
+                    logger.info('Skipping subsets of line %d with more than '
+                        '%d partial sums', self.ids[position],
+                        self.max_states)
+                    self.skipped += 1
+                    return []
+
+    def _reconstruct(self, position, layers, size, total):
+        positions = [position]
+        while size:
+            other, total = layers[size][total]
+            positions.append(other)
+            size -= 1
+        return sorted(positions)
@@ -0,0 +1,78 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from collections import Counter
+import json
+import math
+import os
+import time
+
+# Events notified to the listeners of a reconciliation with their values:
+#
+# start: run, company, start_date, end_date
+# window: start_date, end_date, lines
+# evict: account, party, lines
+# group: account, party, lines, fresh
+# rules: account, party, matches, seconds
+# size_start: account, party, size, lines
+# size_end: account, party, size, matches, candidates, seconds, timed_out
+# subsets: account, party, lines, matches, skipped, seconds, timed_out
+# group_end: account, party, lines, seconds, completed
+# flush: groups, lines, seconds
+# timeout: date, account, party, size
+# end: run, state, reconciled and the counters and timers of the statistics
+EVENTS = ['start', 'window', 'evict', 'group', 'rules', 'size_start',
+    'size_end', 'subsets', 'group_end', 'flush', 'timeout', 'end']
+
+
+def lines_bucket(lines):
+    'Return the power of two upper bound of lines'
+    return 1 << max(lines - 1, 0).bit_length()
+
+
+def seconds_bucket(seconds):
+    'Return the power of ten upper bound of seconds, at least a millisecond'
+    if seconds <= 0.001:
+        return 0.001
+    return 10 ** math.ceil(math.log10(seconds))
+
+
+class MetricsEmitter(object):
+    '''
+    Listener writing the events of the reconciliations as JSON lines
+
+    Each line has the event, its values, the time and the process id. The
+    end event also includes the histograms of the lines and the seconds per
+    group, as {upper bound: number of groups}.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a', buffering=1)
+        self.lines = Counter()
+        self.seconds = Counter()
+
+    def __call__(self, event, values):
+        record = {
+            'event': event,
+            'time': time.time(),
+            'pid': os.getpid(),
+            }
+        record.update(values)
+        if event == 'group':
+            self.lines[lines_bucket(values['lines'])] += 1
+        elif event == 'group_end':
+            self.seconds[(values['account'], values['party'])] += (
+                values['seconds'])
+        elif event == 'end':
+            record['histograms'] = self.histograms()
+        self.file.write(json.dumps(record, default=str) + '\n')
+
+    def histograms(self):
+        seconds = Counter(seconds_bucket(x) for x in self.seconds.values())
+        return {
+            'group_lines': dict(sorted(self.lines.items())),
+            'group_seconds': dict(sorted(seconds.items())),
+            }
+
+    def close(self):
+        self.file.close()
@@ -51,6 +51,10 @@ tests_require = [
     get_require_version('proteus'),
 ]
 
+extras_require = {
+    'numpy': ['numpy'],
+    }
+
 series = '%s.%s' % (major_version, minor_version)
 if minor_version % 2:
     branch = 'default'
@@ -108,6 +112,7 @@ setup(name='%s_%s' % (PREFIX, MODULE),
         ],
     license='GPL-3',
     install_requires=requires,
+    extras_require=extras_require,
     dependency_links=dependency_links,
     zip_safe=False,
     entry_points="""
@@ -0,0 +1,313 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Benchmark of the reconciliation on synthetic ledgers
+
+The database is the one used by the tests, defined by the
+TRYTOND_DATABASE_URI and DB_NAME environment variables, for example:
+
+    TRYTOND_DATABASE_URI=postgresql://localhost/ DB_NAME=bench \\
+        python -m trytond.modules.account_reconcile.tests.benchmark \\
+        --lines 5000 --max-lines 2,3,4 --json bench.jsonl
+
+The ledger is created once and each strategy and max_lines setting is run
+on its own transaction which is rolled back. The peak memory of each run is
+the one allocated by Python and traced with tracemalloc, in bytes.
+'''
+import argparse
+import datetime as dt
+import json
+import random
+import sys
+import time
+import tracemalloc
+from decimal import Decimal
+
+from trytond.pool import Pool
+from trytond.tests.test_tryton import DB_NAME, USER, activate_module
+from trytond.transaction import Transaction, TransactionError
+
+STRATEGIES = {
+    'rules': {'use_rules': True, 'use_combinations': False},
+    'combinations': {'use_rules': False, 'use_combinations': True},
+    'all': {'use_rules': True, 'use_combinations': True},
+    }
+RULE_EXPRESSION = 'nº(\\d+)'
+
+
+class LedgerGenerator(object):
+    '''
+    Deterministic generator of synthetic receivable lines
+
+    Each document is an invoice paid by one payment or, with split_ratio
+    probability, by two or three partial payments. With rule_ratio
+    probability the descriptions contain the document number matched by
+    RULE_EXPRESSION and with unmatched_ratio probability the document is
+    left partially paid.
+    '''
+    distributions = ['uniform', 'lognormal', 'round']
+
+    def __init__(self, lines=1000, parties=10, accounts=1, days=365,
+            distribution='uniform', split_ratio=0.2, rule_ratio=0.5,
+            unmatched_ratio=0.1, seed=0):
+        assert distribution in self.distributions
+        self.lines = lines
+        self.parties = parties
+        self.accounts = accounts
+        self.days = days
+        self.distribution = distribution
+        self.split_ratio = split_ratio
+        self.rule_ratio = rule_ratio
+        self.unmatched_ratio = unmatched_ratio
+        self.seed = seed
+
+    def amount(self, generator):
+        if self.distribution == 'lognormal':
+            amount = generator.lognormvariate(5, 1.5)
+        elif self.distribution == 'round':
+            amount = generator.choice([10, 20, 50, 100, 200, 500, 1000])
+        else:
+            amount = generator.uniform(1, 1000)
+        return Decimal(str(round(max(amount, 0.01), 2)))
+
+    def split(self, generator, amount):
+        'Split amount in two or three positive parts'
+        cents = int(amount * 100)
+        count = min(generator.randint(2, 3), cents)
+        cuts = sorted(generator.sample(range(1, cents), count - 1))
+        parts = [b - a for a, b in zip([0] + cuts, cuts + [cents])]
+        return [Decimal(x) / 100 for x in parts]
+
+    def generate(self):
+        '''
+        Return the list of (account, party, day, amount, description) with
+        account and party as indexes and day as offset from the start
+        '''
+        generator = random.Random(self.seed)
+        result = []
+        number = 0
+        while len(result) < self.lines:
+            number += 1
+            account = generator.randrange(self.accounts)
+            party = generator.randrange(self.parties)
+            day = generator.randrange(self.days)
+            amount = self.amount(generator)
+            if generator.random() < self.rule_ratio:
+                invoice = 'Invoice nº%d' % number
+                payment = 'Payment of invoice nº%d' % number
+            else:
+                invoice, payment = 'Invoice', 'Payment'
+            result.append((account, party, day, amount, invoice))
+            if generator.random() < self.unmatched_ratio:
+                amount -= min(self.amount(generator),
+                    (amount / 2).quantize(Decimal('0.01')))
+            if amount >= Decimal('0.03') and (
+                    generator.random() < self.split_ratio):
+                payments = self.split(generator, amount)
+            else:
+                payments = [amount]
+            for part in payments:
+                payment_day = min(day + generator.randint(0, 20),
+                    self.days - 1)
+                result.append((account, party, payment_day, -part, payment))
+        return result[:self.lines]
+
+
+def setup_ledger(generator):
+    'Create the company, accounts, parties and moves and return the company'
+    from trytond.modules.account.tests import create_chart, get_fiscalyear
+    from trytond.modules.company.tests import create_company, set_company
+
+    pool = Pool()
+    Account = pool.get('account.account')
+    FiscalYear = pool.get('account.fiscalyear')
+    Journal = pool.get('account.journal')
+    Move = pool.get('account.move')
+    Party = pool.get('party.party')
+    Period = pool.get('account.period')
+    ReconcileRule = pool.get('account.move_reconcile.rule')
+
+    company = create_company()
+    with set_company(company):
+        create_chart(company)
+        fiscalyear = get_fiscalyear(company)
+        fiscalyear.save()
+        FiscalYear.create_period([fiscalyear])
+
+        def account(type_):
+            account, = Account.search([
+                    (type_, '=', True),
+                    ('company', '=', company.id),
+                    ('closed', '=', False),
+                    ], limit=1)
+            return account
+        receivable = account('type.receivable')
+        revenue = account('type.revenue')
+        cash, = Account.search([
+                ('company', '=', company.id),
+                ('code', '=', '1.1.1'),
+                ], limit=1)
+        accounts = [receivable]
+        if generator.accounts > 1:
+            accounts += Account.copy([receivable] * (generator.accounts - 1))
+        ReconcileRule.create([{
+                    'account': a.id,
+                    'expression': RULE_EXPRESSION,
+                    } for a in accounts])
+        parties = Party.create([{'name': 'Party %d' % i}
+                for i in range(generator.parties)])
+        journals = {j.code: j for j in Journal.search([])}
+
+        start_date = fiscalyear.start_date
+        vlist = []
+        for account, party, day, amount, description in generator.generate():
+            date = start_date + dt.timedelta(days=day)
+            if amount > 0:
+                journal, counterpart = journals['REV'], revenue
+            else:
+                journal, counterpart = journals['CASH'], cash
+            vlist.append({
+                    'company': company.id,
+                    'period': Period.find(company, date=date),
+                    'journal': journal.id,
+                    'date': date,
+                    'lines': [('create', [{
+                                    'account': counterpart.id,
+                                    'debit': max(-amount, 0),
+                                    'credit': max(amount, 0),
+                                    }, {
+                                    'account': accounts[account].id,
+                                    'party': parties[party].id,
+                                    'debit': max(amount, 0),
+                                    'credit': max(-amount, 0),
+                                    'description': description,
+                                    }])],
+                    })
+        for i in range(0, len(vlist), 1000):
+            Move.post(Move.create(vlist[i:i + 1000]))
+    return company.id
+
+
+def benchmark(company_id, strategy, max_lines, max_days, timeout,
+        trace_memory=True):
+    'Run the reconciliation and return its measures'
+    from trytond.modules.company.tests import set_company
+
+    pool = Pool()
+    Company = pool.get('company.company')
+    Run = pool.get('account.move_reconcile.run')
+    ReconcileMoves = pool.get('account.move_reconcile', type='wizard')
+
+    company = Company(company_id)
+    values = {
+        'company': company.id,
+        'accounts': [],
+        'parties': [],
+        'max_lines': str(max_lines),
+        'max_days': max_days,
+        'start_date': None,
+        'end_date': None,
+        'timeout': dt.timedelta(seconds=timeout),
+        'background': False,
+        }
+    values.update(STRATEGIES[strategy])
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with set_company(company):
+        reconciled = ReconcileMoves.run(values)
+    elapsed = time.perf_counter() - start
+    peak = None
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    run, = Run.search([], order=[('id', 'DESC')], limit=1)
+    search = run.search_duration.total_seconds()
+    return {
+        'strategy': strategy,
+        'max_lines': max_lines,
+        'state': run.state,
+        'seconds': round(elapsed, 3),
+        'lines': run.lines,
+        'lines_per_second': round(run.lines / elapsed, 1) if elapsed else 0,
+        'combinations': run.combinations,
+        'combinations_per_second': (
+            round(run.combinations / search, 1) if search else 0),
+        'rule_matches': run.rule_matches,
+        'combination_matches': run.combination_matches,
+        'reconciled': len(reconciled),
+        'peak_memory': peak,
+        }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--lines', type=int, default=1000)
+    parser.add_argument('--parties', type=int, default=10)
+    parser.add_argument('--accounts', type=int, default=1)
+    parser.add_argument('--days', type=int, default=365,
+        help='days of the fiscal year covered (at most 365)')
+    parser.add_argument('--distribution', default='uniform',
+        choices=LedgerGenerator.distributions)
+    parser.add_argument('--split-ratio', type=float, default=0.2)
+    parser.add_argument('--rule-ratio', type=float, default=0.5)
+    parser.add_argument('--unmatched-ratio', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--strategies', default='rules,combinations,all')
+    parser.add_argument('--max-lines', default='2,3,4')
+    parser.add_argument('--max-days', type=int, default=30)
+    parser.add_argument('--timeout', type=int, default=600,
+        help='maximum seconds of each run')
+    parser.add_argument('--no-trace-memory', dest='trace_memory',
+        action='store_false',
+        help='do not measure the peak memory of each run, as tracemalloc '
+        'slows down the runs')
+    parser.add_argument('--json', metavar='FILE',
+        help='append the results as JSON lines to FILE')
+    args = parser.parse_args(argv)
+
+    generator = LedgerGenerator(lines=args.lines, parties=args.parties,
+        accounts=args.accounts, days=min(args.days, 365),
+        distribution=args.distribution, split_ratio=args.split_ratio,
+        rule_ratio=args.rule_ratio, unmatched_ratio=args.unmatched_ratio,
+        seed=args.seed)
+    activate_module('account_reconcile')
+    extras = {}
+    while True:
+        with Transaction().start(DB_NAME, USER, **extras) as transaction:
+            try:
+                company_id = setup_ledger(generator)
+            except TransactionError as e:
+                transaction.rollback()
+                e.fix(extras)
+                continue
+            transaction.commit()
+            break
+
+    parameters = {k: v for k, v in vars(args).items()
+        if k not in {'strategies', 'max_lines', 'json', 'trace_memory'}}
+    output = open(args.json, 'a') if args.json else None
+    columns = ['strategy', 'max_lines', 'state', 'seconds',
+        'lines_per_second', 'combinations_per_second', 'rule_matches',
+        'combination_matches', 'reconciled', 'peak_memory']
+    print(' '.join(columns))
+    try:
+        for strategy in args.strategies.split(','):
+            for max_lines in map(int, args.max_lines.split(',')):
+                with Transaction().start(DB_NAME, USER) as transaction:
+                    result = benchmark(company_id, strategy, max_lines,
+                        args.max_days, args.timeout, args.trace_memory)
+                    transaction.rollback()
+                print(' '.join('%*s' % (len(c), result[c])
+                        for c in columns))
+                if output:
+                    result.update(parameters,
+                        date=dt.datetime.now().isoformat())
+                    output.write(json.dumps(result) + '\n')
+    finally:
+        if output:
+            output.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,16 +2,41 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
+import json
+import os
+import random
+import re
+import tempfile
+import time
+import unittest
+from datetime import date, timedelta
 from decimal import Decimal
+from itertools import combinations
+from unittest.mock import Mock, patch
+from sql import Literal, Select
+from sql.functions import Substring
+from trytond import backend
+from trytond.config import config
 from trytond.pool import Pool
+from trytond.transaction import Transaction
 from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.modules.company.tests import create_company, set_company, CompanyTestMixin
 from trytond.modules.account.tests import create_chart, get_fiscalyear
+from trytond.modules.account_reconcile.account import (
+    WATERMARK_MARGIN, ReconcilePlanner, ReconcileScheduler, ReconcileWindow,
+    Replace, RuleExpressions)
+from trytond.modules.account_reconcile import combination
+from trytond.modules.account_reconcile.combination import (
+    CombinationMatcher, SubsetSumMatcher, estimate_cost, max_size,
+    scale_amounts)
+from trytond.modules.account_reconcile.metrics import (
+    lines_bucket, seconds_bucket)
+from trytond.modules.account_reconcile.tests.benchmark import (
+    LedgerGenerator)
 
 
-class AccountReconcileTestCase(CompanyTestMixin, ModuleTestCase):
-    'Test AccountReconcile module'
-    module = 'account_reconcile'
+class ReconcileMovesMixin(object):
+    'Create the charts and moves to reconcile'
 
     def create_fiscalyear_and_chart(self, company=None):
         'Test fiscalyear'
@@ -368,6 +393,52 @@ class AccountReconcileTestCase(CompanyTestMixin, ModuleTestCase):
         moves = Move.create(vlist)
         Move.post(moves)
 
+    def create_receivable_moves(self, company, party, values, origin=None):
+        '''
+        Create a move for each (date, amount, description) with a receivable
+        line of amount for party and origin
+        '''
+        pool = Pool()
+        Move = pool.get('account.move')
+        Period = pool.get('account.period')
+        journals = self.get_journals()
+        accounts = self.get_accounts(company)
+        vlist = []
+        for date, amount, description in values:
+            if amount > 0:
+                journal, counterpart = journals['REV'], accounts['revenue']
+            else:
+                journal, counterpart = journals['CASH'], accounts['cash']
+            vlist.append({
+                    'company': company.id,
+                    'period': Period.find(company, date=date),
+                    'journal': journal.id,
+                    'date': date,
+                    'origin': origin,
+                    'lines': [
+                        ('create', [{
+                                    'account': counterpart.id,
+                                    'debit': max(-amount, Decimal(0)),
+                                    'credit': max(amount, Decimal(0)),
+                                    }, {
+                                    'account': accounts['receivable'].id,
+                                    'debit': max(amount, Decimal(0)),
+                                    'credit': max(-amount, Decimal(0)),
+                                    'party': party.id,
+                                    'description': description,
+                                    }]),
+                        ],
+                    })
+        moves = Move.create(vlist)
+        Move.post(moves)
+        return moves
+
+
+class AccountReconcileTestCase(
+        ReconcileMovesMixin, CompanyTestMixin, ModuleTestCase):
+    'Test AccountReconcile module'
+    module = 'account_reconcile'
+
     @with_transaction()
     def test_basic_reconciliation(self):
         'Test basic reconciliation'
@@ -614,6 +685,7 @@ class AccountReconcileTestCase(CompanyTestMixin, ModuleTestCase):
         'Test full reconciliation'
         pool = Pool()
         Line = pool.get('account.move.line')
+        Run = pool.get('account.move_reconcile.run')
         MoveReconcile = pool.get('account.move_reconcile', type='wizard')
         company = create_company()
         self.create_moves(company)
@@ -643,6 +715,13 @@ class AccountReconcileTestCase(CompanyTestMixin, ModuleTestCase):
                     ])
         self.assertEqual(len(data['res_id']), 15)
         self.assertEqual(len(to_reconcile), 0)
+        run, = Run.search([])
+        self.assertEqual(run.state, 'done')
+        self.assertEqual(run.lines, 15)
+        self.assertEqual(run.reconciled, 15)
+        self.assertEqual(run.rule_matches, 0)
+        self.assertEqual(run.combination_matches, 5)
+        self.assertGreater(run.combinations, 0)
 
     @with_transaction()
     def test_balanced_reconciliation(self):
@@ -793,5 +872,1577 @@ class AccountReconcileTestCase(CompanyTestMixin, ModuleTestCase):
         # All moves should be on the same reconciliation
         self.assertEqual(len(reconciliations), 1)
 
+    @with_transaction()
+    def test_rule_reconciliation(self):
+        'Test reconciliation using rules'
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        ReconcileRule = pool.get('account.move_reconcile.rule')
+        MoveReconcile = pool.get('account.move_reconcile', type='wizard')
+        company = create_company()
+        fiscalyear = self.create_fiscalyear_and_chart(company)
+        period = fiscalyear.periods[0]
+        receivable = self.get_accounts(company)['receivable']
+        party = self.create_parties(company)[0]
+        self.create_receivable_moves(company, party, [
+                (period.start_date, Decimal(100), 'Invoice nº 1 001'),
+                (period.start_date, Decimal(-60),
+                    'Payment of invoice nº 1 001'),
+                (period.start_date, Decimal(-40),
+                    'Payment of invoice nº 1001'),
+                (period.start_date, Decimal(30), 'Invoice nº 2'),
+                (period.start_date, Decimal(-20), 'Payment of invoice nº 2'),
+                ])
+        with set_company(company):
+            ReconcileRule.create([{
+                        'account': receivable.id,
+                        'expression': 'nº((\\d|\\s)+)',
+                        }])
+        session_id, _, _ = MoveReconcile.create()
+        move_reconcile = MoveReconcile(session_id)
+        move_reconcile.start.company = company
+        move_reconcile.start.max_lines = '2'
+        move_reconcile.start.max_days = 365
+        move_reconcile.start.timeout = 500
+        move_reconcile.start.use_rules = True
+        move_reconcile.start.use_combinations = False
+        move_reconcile.start.start_date = None
+        move_reconcile.start.end_date = None
+        move_reconcile.start.accounts = []
+        move_reconcile.start.parties = []
+        with set_company(company):
+            _, data = move_reconcile.do_reconcile(None)
+        to_reconcile = Line.search([
+                    ('account.reconcile', '=', True),
+                    ('reconciliation', '=', None),
+                    ])
+        self.assertEqual(len(data['res_id']), 3)
+        self.assertEqual(len(to_reconcile), 2)
+        reconciliations = set([l.reconciliation for l in Line.browse(
+                data['res_id'])])
+        self.assertEqual(len(reconciliations), 1)
+
+    @with_transaction()
+    def test_rule_evicted_reconciliation(self):
+        'Test the rule keys of the lines leaving the window are matched'
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        ReconcileRule = pool.get('account.move_reconcile.rule')
+        MoveReconcile = pool.get('account.move_reconcile', type='wizard')
+        company = create_company()
+        fiscalyear = self.create_fiscalyear_and_chart(company)
+        start_date = fiscalyear.start_date
+        receivable = self.get_accounts(company)['receivable']
+        party = self.create_parties(company)[0]
+        self.create_receivable_moves(company, party, [
+                (start_date, Decimal(100), 'Invoice nº7'),
+                (start_date + timedelta(days=40), Decimal(50), 'Invoice nº7'),
+                (start_date + timedelta(days=50), Decimal(-50),
+                    'Payment nº7'),
+                (start_date + timedelta(days=80), Decimal(10), None),
+                ])
+        with set_company(company):
+            ReconcileRule.create([{
+                        'account': receivable.id,
+                        'expression': 'nº((\\d|\\s)+)',
+                        }])
+        values = {
+            'company': company.id,
+            'accounts': [],
+            'parties': [],
+            'max_lines': '2',
+            'max_days': 60,
+            'start_date': None,
+            'end_date': None,
+            'timeout': timedelta(seconds=500),
+            'use_rules': True,
+            'use_combinations': False,
+            }
+        with set_company(company):
+            reconciled = Line.browse(MoveReconcile.run(values))
+        self.assertEqual(sorted(l.debit - l.credit for l in reconciled),
+            [Decimal(-50), Decimal(50)])
+
+    @with_transaction()
+    def test_reference_evicted_reconciliation(self):
+        'Test the references of the lines leaving the window are matched'
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        MoveReconcile = pool.get('account.move_reconcile', type='wizard')
+        company = create_company()
+        fiscalyear = self.create_fiscalyear_and_chart(company)
+        start_date = fiscalyear.start_date
+        party = self.create_parties(company)[0]
+        self.create_receivable_moves(company, party, [
+                (start_date, Decimal(100), None),
+                (start_date + timedelta(days=40), Decimal(50), None),
+                (start_date + timedelta(days=50), Decimal(-50), None),
+                ], origin=str(fiscalyear))
+        self.create_receivable_moves(company, party, [
+                (start_date + timedelta(days=80), Decimal(10), None),
+                ])
+        values = {
+            'company': company.id,
+            'accounts': [],
+            'parties': [],
+            'max_lines': '2',
+            'max_days': 60,
+            'start_date': None,
+            'end_date': None,
+            'timeout': timedelta(seconds=500),
+            'use_rules': False,
+            'use_combinations': False,
+            'use_references': True,
+            'references': ['move_origin'],
+            }
+        reconciled = Line.browse(MoveReconcile.run(values))
+        self.assertEqual(sorted(l.debit - l.credit for l in reconciled),
+            [Decimal(-50), Decimal(50)])
+
+    @with_transaction()
+    def test_reference_reconciliation(self):
+        'Test lines sharing a reference are reconciled first'
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Run = pool.get('account.move_reconcile.run')
+        MoveReconcile = pool.get('account.move_reconcile', type='wizard')
+        company = create_company()
+        fiscalyear = self.create_fiscalyear_and_chart(company)
+        start_date = fiscalyear.start_date
+        party = self.create_parties(company)[0]
+        self.create_receivable_moves(company, party, [
+                (start_date, Decimal(100), None),
+                (start_date + timedelta(days=1), Decimal(-60), None),
+                (start_date + timedelta(days=2), Decimal(-40), None),
+                ], origin=str(fiscalyear))
+        move, _ = self.create_receivable_moves(company, party, [
+                (start_date, Decimal(50), None),
+                (start_date + timedelta(days=1), Decimal(-30), None),
+                ])
+        self.create_receivable_moves(company, party, [
+                (start_date + timedelta(days=3), Decimal(70), None),
+                (start_date + timedelta(days=4), Decimal(-70), None),
+                ], origin=str(move))
+        values = {
+            'company': company.id,
+            'accounts': [],
+            'parties': [],
+            'max_lines': '2',
+            'max_days': 60,
+            'start_date': None,
+            'end_date': None,
+            'timeout': timedelta(seconds=500),
+            'use_rules': False,
+            'use_combinations': False,
+            'use_references': True,
+            'references': ['move_origin'],
+            }
+        reconciled = Line.browse(MoveReconcile.run(values))
+        self.assertEqual(sorted(l.debit - l.credit for l in reconciled),
+            [Decimal(-70), Decimal(-60), Decimal(-40), Decimal(70),
+                Decimal(100)])
+        self.assertEqual(len({l.reconciliation for l in reconciled}), 2)
+        run, = Run.search([])
+        self.assertEqual(run.reference_matches, 2)
+        self.assertEqual(run.references, ('move_origin',))
+        to_reconcile = Line.search([
+                    ('party', '=', party),
+                    ('reconciliation', '=', None),
+                    ])
+        self.assertEqual(sorted(l.debit - l.credit for l in to_reconcile),
+            [Decimal(-30), Decimal(50)])
+
+    @with_transaction()
+    def test_rule_expressions_cache(self):
+        'Test rule expressions are cached until a rule is modified'
+        pool = Pool()
+        ReconcileRule = pool.get('account.move_reconcile.rule')
+        company = create_company()
+        self.create_fiscalyear_and_chart(company)
+        receivable = self.get_accounts(company)['receivable']
+        with set_company(company):
+            rule, = ReconcileRule.create([{
+                        'account': receivable.id,
+                        'expression': 'nº(\\d+)',
+                        }])
+        expressions = ReconcileRule.get_expressions(company.id, receivable.id)
+        self.assertEqual(expressions.key('Invoice nº12'), '12')
+        self.assertEqual(ReconcileRule.get_expressions(
+                company.id, receivable.id).key('Invoice nº12'), '12')
+
+        ReconcileRule.write([rule], {'expression': 'Invoice nº(\\d)'})
+        expressions = ReconcileRule.get_expressions(company.id, receivable.id)
+        self.assertEqual(expressions.key('Invoice nº12'), '1')
+
+        ReconcileRule.delete([rule])
+        expressions = ReconcileRule.get_expressions(company.id, receivable.id)
+        self.assertFalse(expressions)
+
+    @with_transaction()
+    def test_window_reconciliation(self):
+        'Test reconciliation only combines lines within max days'
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        MoveReconcile = pool.get('account.move_reconcile', type='wizard')
+        company = create_company()
+        fiscalyear = self.create_fiscalyear_and_chart(company)
+        start_date = fiscalyear.start_date
+        party = self.create_parties(company)[0]
+        self.create_receivable_moves(company, party, [
+                (start_date, Decimal(100), None),
+                (start_date + timedelta(days=20), Decimal(-100), None),
+                (start_date + timedelta(days=50), Decimal(30), None),
+                (start_date + timedelta(days=75), Decimal(-30), None),
+                (start_date + timedelta(days=80), Decimal(10), None),
+                (start_date + timedelta(days=180), Decimal(-10), None),
+                ])
+        session_id, _, _ = MoveReconcile.create()
+        move_reconcile = MoveReconcile(session_id)
+        move_reconcile.start.company = company
+        move_reconcile.start.max_lines = '2'
+        move_reconcile.start.max_days = 30
+        move_reconcile.start.timeout = 500
+        move_reconcile.start.use_rules = False
+        move_reconcile.start.use_combinations = True
+        move_reconcile.start.start_date = None
+        move_reconcile.start.end_date = None
+        move_reconcile.start.accounts = []
+        move_reconcile.start.parties = []
+        _, data = move_reconcile.do_reconcile(None)
+        to_reconcile = Line.search([
+                    ('account.reconcile', '=', True),
+                    ('reconciliation', '=', None),
+                    ])
+        self.assertEqual(len(data['res_id']), 4)
+        self.assertEqual(len(to_reconcile), 2)
+        self.assertEqual(
+            sorted(l.debit - l.credit for l in to_reconcile),
+            [Decimal(-10), Decimal(10)])
+
+    @with_transaction()
+    def test_metrics(self):
+        'Test the events of the reconciliation are written as JSON lines'
+        pool = Pool()
+        MoveReconcile = pool.get('account.move_reconcile', type='wizard')
+        company = create_company()
+        self.create_moves(company)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'metrics.jsonl')
+            if not config.has_section('account_reconcile'):
+                config.add_section('account_reconcile')
+                self.addCleanup(config.remove_section, 'account_reconcile')
+            config.set('account_reconcile', 'metrics', path)
+            self.addCleanup(
+                config.remove_option, 'account_reconcile', 'metrics')
+            reconciled = MoveReconcile.run({
+                    'company': company.id,
+                    'accounts': [],
+                    'parties': [],
+                    'max_lines': '3',
+                    'max_days': 365,
+                    'start_date': None,
+                    'end_date': None,
+                    'timeout': timedelta(seconds=500),
+                    'use_rules': False,
+                    'use_combinations': True,
+                    })
+            with open(path) as file:
+                records = [json.loads(l) for l in file]
+        events = [r['event'] for r in records]
+        self.assertEqual(events[0], 'start')
+        self.assertEqual(events[-1], 'end')
+        for event in ['window', 'group', 'size_start', 'size_end',
+                'group_end', 'flush']:
+            self.assertIn(event, events)
+        end = records[-1]
+        self.assertEqual(end['state'], 'done')
+        self.assertEqual(end['reconciled'], len(reconciled))
+        self.assertEqual(
+            sum(r['lines'] for r in records if r['event'] == 'flush'),
+            len(reconciled))
+        self.assertEqual(
+            sum(end['histograms']['group_lines'].values()),
+            events.count('group'))
+
+    @with_transaction()
+    def test_metrics_closed(self):
+        'Test the listeners are closed when the reconciliation fails'
+        pool = Pool()
+        MoveReconcile = pool.get('account.move_reconcile', type='wizard')
+        company = create_company()
+        self.create_moves(company)
+        listener = Mock()
+        with patch.object(MoveReconcile, '_get_listeners',
+                    return_value=[listener]), \
+                patch.object(MoveReconcile, 'reconciliation',
+                    side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                MoveReconcile.run({
+                        'company': company.id,
+                        'accounts': [],
+                        'parties': [],
+                        'max_lines': '3',
+                        'max_days': 365,
+                        'start_date': None,
+                        'end_date': None,
+                        'timeout': timedelta(seconds=500),
+                        'use_rules': False,
+                        'use_combinations': True,
+                        })
+        listener.close.assert_called_once_with()
+
+    @with_transaction()
+    def test_group_cost(self):
+        'Test the cost of a group grows with its combinations'
+        pool = Pool()
+        MoveReconcile = pool.get('account.move_reconcile', type='wizard')
+        session_id, _, _ = MoveReconcile.create()
+        wizard = MoveReconcile(session_id)
+        wizard.start.use_combinations = False
+        self.assertEqual(wizard._get_cost(10, 4, 1000, 1000), 10)
+        wizard.start.use_combinations = True
+        self.assertEqual(wizard._get_cost(10, 4, 1000, 1000),
+            10 + 10 + 100 + 90)
+        self.assertEqual(wizard._get_cost(10, 4, 150, 1000), 10 + 10 + 100)
+
+    @with_transaction()
+    def test_pair_reconciliation(self):
+        'Test opposite amounts are paired by date before the combinations'
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Run = pool.get('account.move_reconcile.run')
+        MoveReconcile = pool.get('account.move_reconcile', type='wizard')
+        company = create_company()
+        fiscalyear = self.create_fiscalyear_and_chart(company)
+        start_date = fiscalyear.start_date
+        party = self.create_parties(company)[0]
+        self.create_receivable_moves(company, party, [
+                (start_date, Decimal(100), 'A'),
+                (start_date + timedelta(days=5), Decimal(100), 'B'),
+                (start_date + timedelta(days=6), Decimal(-100), 'A'),
+                (start_date + timedelta(days=7), Decimal(50), 'C'),
+                (start_date + timedelta(days=50), Decimal(-100), 'B'),
+                ])
+        session_id, _, _ = MoveReconcile.create()
+        move_reconcile = MoveReconcile(session_id)
+        move_reconcile.start.company = company
+        move_reconcile.start.max_lines = '2'
+        move_reconcile.start.max_days = 30
+        move_reconcile.start.timeout = 500
+        move_reconcile.start.use_rules = False
+        move_reconcile.start.use_combinations = True
+        move_reconcile.start.start_date = None
+        move_reconcile.start.end_date = None
+        move_reconcile.start.accounts = []
+        move_reconcile.start.parties = []
+        _, data = move_reconcile.do_reconcile(None)
+        reconciled = Line.browse(data['res_id'])
+        self.assertEqual({l.description for l in reconciled}, {'A'})
+        self.assertEqual(len(reconciled), 2)
+        run, = Run.search([])
+        self.assertEqual(run.combination_matches, 1)
+        self.assertEqual(run.lines, 5)
+
+    @with_transaction()
+    def test_span_reconciliation(self):
+        'Test combinations are limited to the maximum span'
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        MoveReconcile = pool.get('account.move_reconcile', type='wizard')
+        company = create_company()
+        fiscalyear = self.create_fiscalyear_and_chart(company)
+        start_date = fiscalyear.start_date
+        party = self.create_parties(company)[0]
+        self.create_receivable_moves(company, party, [
+                (start_date, Decimal(100), None),
+                (start_date + timedelta(days=15), Decimal(-60), None),
+                (start_date + timedelta(days=16), Decimal(-40), None),
+                (start_date + timedelta(days=20), Decimal(30), None),
+                (start_date + timedelta(days=22), Decimal(-10), None),
+                (start_date + timedelta(days=23), Decimal(-20), None),
+                ])
+        values = {
+            'company': company.id,
+            'accounts': [],
+            'parties': [],
+            'max_lines': '3',
+            'max_days': 60,
+            'max_span': 10,
+            'start_date': None,
+            'end_date': None,
+            'timeout': timedelta(seconds=500),
+            'use_rules': False,
+            'use_combinations': True,
+            }
+        reconciled = Line.browse(MoveReconcile.run(values))
+        self.assertEqual(sorted(l.debit - l.credit for l in reconciled),
+            [Decimal(-20), Decimal(-10), Decimal(30)])
+        values['max_span'] = None
+        reconciled = Line.browse(MoveReconcile.run(values))
+        self.assertEqual(sorted(l.debit - l.credit for l in reconciled),
+            [Decimal(-60), Decimal(-40), Decimal(100)])
+
+    @with_transaction()
+    def test_tolerance_reconciliation(self):
+        'Test combinations within the tolerance are written off'
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Run = pool.get('account.move_reconcile.run')
+        WriteOff = pool.get('account.move.reconcile.write_off')
+        MoveReconcile = pool.get('account.move_reconcile', type='wizard')
+        company = create_company()
+        fiscalyear = self.create_fiscalyear_and_chart(company)
+        start_date = fiscalyear.start_date
+        party = self.create_parties(company)[0]
+        accounts = self.get_accounts(company)
+        with set_company(company):
+            write_off = WriteOff(name='Differences',
+                journal=self.get_journals()['EXC'],
+                credit_account=accounts['revenue'],
+                debit_account=accounts['expense'])
+            write_off.save()
+        self.create_receivable_moves(company, party, [
+                (start_date, Decimal(100), None),
+                (start_date + timedelta(days=1), Decimal('-99.97'), None),
+                (start_date + timedelta(days=2), Decimal(50), None),
+                (start_date + timedelta(days=3), Decimal('-49.90'), None),
+                ])
+        values = {
+            'company': company.id,
+            'accounts': [],
+            'parties': [],
+            'max_lines': '2',
+            'max_days': 60,
+            'tolerance': Decimal('0.05'),
+            'write_off': write_off.id,
+            'start_date': None,
+            'end_date': None,
+            'timeout': timedelta(seconds=500),
+            'use_rules': False,
+            'use_combinations': True,
+            }
+        with set_company(company):
+            reconciled = Line.browse(MoveReconcile.run(values))
+        self.assertEqual(sorted(l.debit - l.credit for l in reconciled),
+            [Decimal('-99.97'), Decimal(100)])
+        reconciliation = reconciled[0].reconciliation
+        self.assertEqual(len(reconciliation.lines), 3)
+        self.assertEqual(sum(l.debit - l.credit
+                for l in reconciliation.lines), Decimal(0))
+        to_reconcile = Line.search([
+                    ('account', '=', accounts['receivable'].id),
+                    ('reconciliation', '=', None),
+                    ])
+        self.assertEqual(sorted(l.debit - l.credit for l in to_reconcile),
+            [Decimal('-49.90'), Decimal(50)])
+        run, = Run.search([])
+        self.assertEqual(run.write_off, write_off)
+
+    @with_transaction()
+    def test_subset_sum_reconciliation(self):
+        'Test a payment of more invoices than the maximum lines'
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Run = pool.get('account.move_reconcile.run')
+        MoveReconcile = pool.get('account.move_reconcile', type='wizard')
+        company = create_company()
+        fiscalyear = self.create_fiscalyear_and_chart(company)
+        start_date = fiscalyear.start_date
+        party = self.create_parties(company)[0]
+        invoices = [Decimal(10 + i) for i in range(12)]
+        self.create_receivable_moves(company, party,
+            [(start_date, x, None) for x in invoices]
+            + [(start_date + timedelta(days=5), -sum(invoices[:9]), None)])
+        values = {
+            'company': company.id,
+            'accounts': [],
+            'parties': [],
+            'max_lines': '6',
+            'max_days': 60,
+            'use_subset_sum': False,
+            'max_subset_lines': 10,
+            'start_date': None,
+            'end_date': None,
+            'timeout': timedelta(seconds=500),
+            'use_rules': False,
+            'use_combinations': True,
+            }
+        self.assertEqual(MoveReconcile.run(values), [])
+        values['use_subset_sum'] = True
+        reconciled = Line.browse(MoveReconcile.run(values))
+        self.assertGreater(len(reconciled), 6)
+        self.assertIn(-sum(invoices[:9]),
+            [l.debit - l.credit for l in reconciled])
+        self.assertEqual(sum(l.debit - l.credit for l in reconciled),
+            Decimal(0))
+        run = Run.search([], order=[('id', 'DESC')], limit=1)[0]
+        self.assertEqual(run.max_subset_lines, 10)
+        self.assertEqual(run.combination_matches, 1)
+
+    @with_transaction()
+    def test_downgraded_reconciliation(self):
+        'Test groups with too many candidates are downgraded'
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Run = pool.get('account.move_reconcile.run')
+        MoveReconcile = pool.get('account.move_reconcile', type='wizard')
+        company = create_company()
+        fiscalyear = self.create_fiscalyear_and_chart(company)
+        start_date = fiscalyear.start_date
+        party = self.create_parties(company)[0]
+        self.create_receivable_moves(company, party, [
+                (start_date, Decimal(100), None),
+                (start_date, Decimal(-60), None),
+                (start_date, Decimal(-40), None),
+                (start_date, Decimal(30), None),
+                (start_date, Decimal(-30), None),
+                ])
+        if not config.has_section('account_reconcile'):
+            config.add_section('account_reconcile')
+            self.addCleanup(config.remove_section, 'account_reconcile')
+        config.set('account_reconcile', 'max_candidates', '10')
+        self.addCleanup(
+            config.remove_option, 'account_reconcile', 'max_candidates')
+        session_id, _, _ = MoveReconcile.create()
+        move_reconcile = MoveReconcile(session_id)
+        move_reconcile.start.company = company
+        move_reconcile.start.max_lines = '3'
+        move_reconcile.start.max_days = 30
+        move_reconcile.start.timeout = 500
+        move_reconcile.start.use_rules = False
+        move_reconcile.start.use_combinations = True
+        move_reconcile.start.start_date = None
+        move_reconcile.start.end_date = None
+        move_reconcile.start.accounts = []
+        move_reconcile.start.parties = []
+        _, data = move_reconcile.do_reconcile(None)
+        self.assertEqual(
+            sorted(l.debit - l.credit for l in Line.browse(data['res_id'])),
+            [Decimal(-30), Decimal(30)])
+        run, = Run.search([])
+        self.assertEqual(run.downgraded, 1)
+        self.assertIn('3 lines', run.downgrades)
+
+    @with_transaction()
+    def test_evicted_reconciliation(self):
+        'Test the lines left out of the window are counted on the run'
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Run = pool.get('account.move_reconcile.run')
+        MoveReconcile = pool.get('account.move_reconcile', type='wizard')
+        company = create_company()
+        fiscalyear = self.create_fiscalyear_and_chart(company)
+        start_date = fiscalyear.start_date
+        party = self.create_parties(company)[0]
+        self.create_receivable_moves(company, party, [
+                (start_date, Decimal(100), None),
+                (start_date, Decimal(-60), None),
+                (start_date, Decimal(-40), None),
+                (start_date + timedelta(days=1), Decimal(50), None),
+                (start_date + timedelta(days=1), Decimal(-20), None),
+                (start_date + timedelta(days=1), Decimal(-30), None),
+                ])
+        if not config.has_section('account_reconcile'):
+            config.add_section('account_reconcile')
+            self.addCleanup(config.remove_section, 'account_reconcile')
+        config.set('account_reconcile', 'window_lines', '3')
+        self.addCleanup(
+            config.remove_option, 'account_reconcile', 'window_lines')
+        session_id, _, _ = MoveReconcile.create()
+        move_reconcile = MoveReconcile(session_id)
+        move_reconcile.start.company = company
+        move_reconcile.start.max_lines = '3'
+        move_reconcile.start.max_days = 30
+        move_reconcile.start.timeout = 500
+        move_reconcile.start.use_rules = False
+        move_reconcile.start.use_combinations = True
+        move_reconcile.start.start_date = None
+        move_reconcile.start.end_date = None
+        move_reconcile.start.accounts = []
+        move_reconcile.start.parties = []
+        _, data = move_reconcile.do_reconcile(None)
+        # Only the latest lines of the group are kept on the window
+        self.assertEqual(
+            sorted(l.debit - l.credit for l in Line.browse(data['res_id'])),
+            [Decimal(-30), Decimal(-20), Decimal(50)])
+        run, = Run.search([])
+        self.assertEqual(run.evicted, 3)
+
+    @with_transaction()
+    def test_proposal_reconciliation(self):
+        'Test proposing the reconciliations and applying the approved ones'
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Run = pool.get('account.move_reconcile.run')
+        Proposal = pool.get('account.move_reconcile.proposal')
+        MoveReconcile = pool.get('account.move_reconcile', type='wizard')
+        company = create_company()
+        self.create_moves(company)
+        values = {
+            'company': company.id,
+            'accounts': [],
+            'parties': [],
+            'max_lines': '3',
+            'max_days': 365,
+            'start_date': None,
+            'end_date': None,
+            'timeout': timedelta(seconds=500),
+            'use_rules': False,
+            'use_combinations': True,
+            'propose': True,
+            }
+        proposed = MoveReconcile.run(values)
+        self.assertEqual(len(proposed), 7)
+        to_reconcile = Line.search([
+                    ('account.reconcile', '=', True),
+                    ('reconciliation', '=', None),
+                    ])
+        self.assertEqual(len(to_reconcile), 7)
+        run, = Run.search([])
+        self.assertEqual(run.reconciled, 0)
+        self.assertEqual(run.combination_matches, len(run.proposals))
+        self.assertEqual(
+            sorted(i for p in run.proposals for i in p.get_line_ids()),
+            sorted(proposed))
+        for proposal in run.proposals:
+            self.assertIn(proposal.strategy, {'pair', 'combination'})
+            self.assertEqual(sum(l.debit - l.credit for l in proposal.lines),
+                Decimal(0))
+
+        # The lines of pending proposals are not proposed again
+        self.assertEqual(MoveReconcile.run(values), [])
+
+        first, *others = run.proposals
+        Line.reconcile(first.lines)
+        Proposal.approve(run.proposals)
+        Run.apply_proposals([run])
+        self.assertEqual(first.state, 'cancelled')
+        self.assertEqual({p.state for p in others}, {'applied'})
+        to_reconcile = Line.search([
+                    ('account.reconcile', '=', True),
+                    ('reconciliation', '=', None),
+                    ])
+        self.assertEqual(to_reconcile, [])
+
+    @with_transaction()
+    def test_proposal_windows(self):
+        'Test the lines proposed on a window are skipped by the next ones'
+        pool = Pool()
+        Run = pool.get('account.move_reconcile.run')
+        ProposalLine = pool.get(
+            'account.move_reconcile.proposal-account.move.line')
+        MoveReconcile = pool.get('account.move_reconcile', type='wizard')
+        company = create_company()
+        fiscalyear = self.create_fiscalyear_and_chart(company)
+        start_date = fiscalyear.start_date
+        party = self.create_parties(company)[0]
+        self.create_receivable_moves(company, party, [
+                (start_date, Decimal(100), None),
+                (start_date + timedelta(days=5), Decimal(-100), None),
+                (start_date + timedelta(days=12), Decimal(100), None),
+                ])
+        values = {
+            'company': company.id,
+            'accounts': [],
+            'parties': [],
+            'max_lines': '2',
+            'max_days': 10,
+            'start_date': None,
+            'end_date': None,
+            'timeout': timedelta(seconds=500),
+            'use_rules': False,
+            'use_combinations': True,
+            'propose': True,
+            }
+        proposed = MoveReconcile.run(values)
+        run, = Run.search([])
+        proposal, = run.proposals
+        self.assertEqual(sorted(proposal.get_line_ids()), sorted(proposed))
+        self.assertEqual(
+            sorted(x.line.id for x in ProposalLine.search([])),
+            sorted(proposed))
+
+    @with_transaction()
+    def test_incremental_reconciliation(self):
+        'Test reconciling only the groups changed since the last run'
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Run = pool.get('account.move_reconcile.run')
+        Cron = pool.get('ir.cron')
+        MoveReconcile = pool.get('account.move_reconcile', type='wizard')
+        company = create_company()
+        self.create_moves(company)
+        self.assertIn('account.move_reconcile.run|reconcile_incremental',
+            dict(Cron.method.selection))
+        with set_company(company):
+            Run.reconcile_incremental()
+        run, = Run.search([])
+        self.assertTrue(run.incremental)
+        self.assertEqual(run.state, 'done')
+        self.assertEqual(run.reconciled, 4)
+        # The lines written by the transactions still running are revisited
+        self.assertEqual(run.watermark,
+            run.create_date.replace(microsecond=0)
+            - timedelta(seconds=WATERMARK_MARGIN))
+
+        values = {
+            'company': company.id,
+            'accounts': [],
+            'parties': [],
+            'max_lines': '3',
+            'max_days': 365,
+            'start_date': None,
+            'end_date': None,
+            'timeout': timedelta(seconds=500),
+            'use_rules': False,
+            'use_combinations': True,
+            'incremental': True,
+            }
+        # No line changed after the watermark
+        watermark = run.watermark
+        Run.write([run], {'watermark': watermark + timedelta(days=1)})
+        self.assertEqual(MoveReconcile.run(values), [])
+        last, = Run.search([('id', '!=', run.id)])
+        self.assertEqual(last.since, watermark + timedelta(days=1))
+        self.assertEqual(last.watermark,
+            last.create_date.replace(microsecond=0)
+            - timedelta(seconds=WATERMARK_MARGIN))
+
+        Run.write([last], {'watermark': watermark - timedelta(days=1)})
+        self.assertEqual(len(MoveReconcile.run(values)), 3)
+        to_reconcile = Line.search([
+                    ('account.reconcile', '=', True),
+                    ('reconciliation', '=', None),
+                    ])
+        self.assertEqual(to_reconcile, [])
+
+    @with_transaction()
+    def test_background_reconciliation(self):
+        'Test reconciliation on the queue'
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Queue = pool.get('ir.queue')
+        MoveReconcile = pool.get('account.move_reconcile', type='wizard')
+        company = create_company()
+        self.create_moves(company)
+        session_id, _, _ = MoveReconcile.create()
+        move_reconcile = MoveReconcile(session_id)
+        move_reconcile.start.company = company
+        move_reconcile.start.max_lines = '2'
+        move_reconcile.start.max_days = 365
+        move_reconcile.start.timeout = 500
+        move_reconcile.start.use_rules = False
+        move_reconcile.start.use_combinations = True
+        move_reconcile.start.background = True
+        move_reconcile.start.start_date = None
+        move_reconcile.start.end_date = None
+        move_reconcile.start.accounts = []
+        move_reconcile.start.parties = []
+        self.assertIsNone(move_reconcile.do_reconcile(None))
+        tasks = Queue.search([
+                ('data.model', '=', 'account.account'),
+                ])
+        # One task for the receivable and one for the payable account
+        self.assertEqual(len(tasks), 2)
+        for task in tasks:
+            task.run()
+        to_reconcile = Line.search([
+                    ('account.reconcile', '=', True),
+                    ('reconciliation', '=', None),
+                    ])
+        self.assertEqual(len(to_reconcile), 3)
+
+    @with_transaction()
+    def test_background_incremental_reconciliation(self):
+        'Test incremental reconciliation on the queue'
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Queue = pool.get('ir.queue')
+        Run = pool.get('account.move_reconcile.run')
+        MoveReconcile = pool.get('account.move_reconcile', type='wizard')
+        company = create_company()
+        self.create_moves(company)
+        session_id, _, _ = MoveReconcile.create()
+        move_reconcile = MoveReconcile(session_id)
+        move_reconcile.start.company = company
+        move_reconcile.start.max_lines = '2'
+        move_reconcile.start.max_days = 365
+        move_reconcile.start.timeout = 500
+        move_reconcile.start.use_rules = False
+        move_reconcile.start.use_combinations = True
+        move_reconcile.start.incremental = True
+        move_reconcile.start.background = True
+        move_reconcile.start.start_date = None
+        move_reconcile.start.end_date = None
+        move_reconcile.start.accounts = []
+        move_reconcile.start.parties = []
+        self.assertIsNone(move_reconcile.do_reconcile(None))
+        batch, = Run.search([])
+        self.assertEqual(batch.tasks, 2)
+        self.assertEqual(batch.state, 'running')
+        self.assertTrue(batch.watermark)
+        self.assertIsNone(Run.get_watermark(company.id))
+        tasks = Queue.search([
+                ('data.model', '=', 'account.account'),
+                ])
+        self.assertEqual(len(tasks), 2)
+        for task in tasks:
+            task.run()
+            # The watermark is not recorded until all the tasks are done
+            if task != tasks[-1]:
+                self.assertIsNone(Run.get_watermark(company.id))
+        to_reconcile = Line.search([
+                    ('account.reconcile', '=', True),
+                    ('reconciliation', '=', None),
+                    ])
+        self.assertEqual(len(to_reconcile), 3)
+        runs = Run.search([('id', '!=', batch.id)])
+        self.assertEqual(len(runs), 2)
+        self.assertEqual({r.batch for r in runs}, {batch.batch})
+        self.assertEqual({r.watermark for r in runs}, {None})
+        self.assertEqual(batch.state, 'done')
+        self.assertEqual(Run.get_watermark(company.id), batch.watermark)
+
+    @with_transaction()
+    def test_parallel_reconciliation(self):
+        'Test the partitions reconciled by separate tasks of the queue'
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Queue = pool.get('ir.queue')
+        Run = pool.get('account.move_reconcile.run')
+        MoveReconcile = pool.get('account.move_reconcile', type='wizard')
+        company = create_company()
+        fiscalyear = self.create_fiscalyear_and_chart(company)
+        start_date = fiscalyear.start_date
+        for party in self.create_parties(company):
+            self.create_receivable_moves(company, party, [
+                    (start_date, Decimal(100), None),
+                    (start_date, Decimal(-60), None),
+                    (start_date, Decimal(-40), None),
+                    ])
+        if not config.has_section('account_reconcile'):
+            config.add_section('account_reconcile')
+            self.addCleanup(config.remove_section, 'account_reconcile')
+        config.set('account_reconcile', 'processes', '2')
+        self.addCleanup(config.remove_option, 'account_reconcile',
+            'processes')
+        session_id, _, _ = MoveReconcile.create()
+        move_reconcile = MoveReconcile(session_id)
+        move_reconcile.start.company = company
+        move_reconcile.start.max_lines = '3'
+        move_reconcile.start.max_days = 60
+        move_reconcile.start.timeout = 500
+        move_reconcile.start.use_rules = False
+        move_reconcile.start.use_combinations = True
+        move_reconcile.start.incremental = True
+        move_reconcile.start.start_date = None
+        move_reconcile.start.end_date = None
+        move_reconcile.start.accounts = []
+        move_reconcile.start.parties = []
+        self.assertIsNone(move_reconcile.do_reconcile(None))
+        batch, = Run.search([])
+        self.assertEqual(batch.tasks, 2)
+        tasks = Queue.search([
+                ('data.model', '=', 'account.account'),
+                ])
+        self.assertEqual(len(tasks), 2)
+        for task in tasks:
+            task.run()
+        lines = Line.search([
+                ('account.reconcile', '=', True),
+                ])
+        self.assertTrue(all(l.reconciliation for l in lines))
+        runs = Run.search([('id', '!=', batch.id)])
+        self.assertEqual(sorted(r.partition for r in runs), [0, 1])
+        self.assertEqual({r.partitions for r in runs}, {2})
+        self.assertEqual(sum(r.reconciled for r in runs), len(lines))
+        # The groups are split among the partitions
+        self.assertTrue(all(r.reconciled for r in runs))
+        self.assertEqual(batch.state, 'done')
+
+    @with_transaction()
+    def test_partitioned_reconciliation(self):
+        'Test reconciliation split in partitions'
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        MoveReconcile = pool.get('account.move_reconcile', type='wizard')
+        transaction = Transaction()
+        company = create_company()
+        self.create_moves(company)
+        values = {
+            'company': company.id,
+            'max_lines': '2',
+            'max_days': 365,
+            'timeout': timedelta(seconds=500),
+            'use_rules': False,
+            'use_combinations': True,
+            'accounts': [],
+            'parties': [],
+            }
+        reconciled = []
+        for partition in range(3):
+            with transaction.set_context(reconcile_partition=(partition, 3)):
+                reconciled += MoveReconcile.run(values)
+        to_reconcile = Line.search([
+                    ('account.reconcile', '=', True),
+                    ('reconciliation', '=', None),
+                    ])
+        self.assertEqual(len(reconciled), 4)
+        self.assertEqual(len(set(reconciled)), 4)
+        self.assertEqual(len(to_reconcile), 3)
+
+    @with_transaction()
+    def test_heavy_group_reconciliation(self):
+        'Test a heavy group does not use the time of the next windows'
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Run = pool.get('account.move_reconcile.run')
+        MoveReconcile = pool.get('account.move_reconcile', type='wizard')
+        company = create_company()
+        fiscalyear = self.create_fiscalyear_and_chart(company)
+        start_date = fiscalyear.start_date
+        heavy, cheap = self.create_parties(company)[:2]
+        # At least six lines are needed to sum zero so every combination of
+        # up to six lines is searched
+        self.create_receivable_moves(company, heavy,
+            [(start_date, Decimal(6 * (i + 1)), None) for i in range(60)]
+            + [(start_date, Decimal(-6 * (i + 1) - 1), None)
+                for i in range(60)])
+        self.create_receivable_moves(company, cheap, [
+                (start_date + timedelta(days=200), Decimal(100), None),
+                (start_date + timedelta(days=200), Decimal(-60), None),
+                (start_date + timedelta(days=200), Decimal(-40), None),
+                ])
+        MoveReconcile.run({
+                'company': company.id,
+                'accounts': [],
+                'parties': [],
+                'max_lines': '6',
+                'max_days': 30,
+                'start_date': None,
+                'end_date': None,
+                'timeout': timedelta(seconds=6),
+                'use_rules': False,
+                'use_combinations': True,
+                })
+        run, = Run.search([])
+        self.assertEqual(run.state, 'done')
+        self.assertGreaterEqual(run.downgraded, 1)
+        self.assertEqual(Line.search([
+                    ('party', '=', cheap.id),
+                    ('reconciliation', '=', None),
+                    ]), [])
+
+    @unittest.skipIf(backend.name != 'postgresql',
+        'The rules are only applied by the database on PostgreSQL')
+    @with_transaction()
+    def test_portable_rules_database(self):
+        'Test the database extracts the key of the portable rules'
+        cursor = Transaction().connection.cursor()
+        expressions = [
+            'INV([0-9]+)',
+            'nº([0-9 ]+)',
+            '^REF-([A-Z0-9]{3,12})',
+            'a*(a+)b?',
+            'x?([xy]*)y',
+            'P(a+)a*\\Z',
+            '([^ ]+) EUR',
+            'é(ü+)',
+            ]
+        descriptions = [
+            'INV 12 INV123',
+            'Invoice nº 1 001 nº2',
+            'REF-ABC123 REF-X',
+            'aaab',
+            'xxyy',
+            'Paaa',
+            'Pa\n',
+            'INV123\n',
+            'total 12 EUR',
+            'éüü',
+            'none',
+            ]
+        for expression in expressions:
+            rule_expressions = RuleExpressions([expression])
+            self.assertTrue(rule_expressions.portable)
+            for description in descriptions:
+                with self.subTest(
+                        expression=expression, description=description):
+                    cursor.execute(*Select([Replace(
+                                    Substring(Literal(description),
+                                        Literal(expression)),
+                                    ' ', '')]))
+                    key, = cursor.fetchone()
+                    self.assertEqual(key, rule_expressions.key(description))
+
+    @with_transaction()
+    def test_resume_reconciliation(self):
+        'Test resuming a timed out reconciliation'
+        pool = Pool()
+        Line = pool.get('account.move.line')
+        Run = pool.get('account.move_reconcile.run')
+        company = create_company()
+        self.create_moves(company)
+        lines = Line.search([
+                    ('account.reconcile', '=', True),
+                    ('reconciliation', '=', None),
+                    ])
+        account, party = min({(l.account.id, l.party.id) for l in lines})
+        # The pairs of the checkpoint are not reconciled by this fake run so
+        # they must not be matched by the database
+        if not config.has_section('account_reconcile'):
+            config.add_section('account_reconcile')
+            self.addCleanup(config.remove_section, 'account_reconcile')
+        config.set('account_reconcile', 'pair_matching', 'False')
+        self.addCleanup(
+            config.remove_option, 'account_reconcile', 'pair_matching')
+        run, = Run.create([{
+                    'company': company.id,
+                    'max_lines': 2,
+                    'max_days': 365,
+                    'timeout': timedelta(seconds=500),
+                    'use_rules': False,
+                    'use_combinations': True,
+                    'state': 'timeout',
+                    'checkpoint_date': min(l.date for l in lines),
+                    'checkpoint_account': account,
+                    'checkpoint_party': party,
+                    'checkpoint_size': None,
+                    }])
+        Run.resume([run])
+        self.assertEqual(run.state, 'resumed')
+        resumed, = Run.search([('id', '!=', run.id)])
+        self.assertEqual(resumed.state, 'done')
+        self.assertEqual(resumed.reconciled, 2)
+        # The group completed by the resumed run is not processed again
+        to_reconcile = Line.search([
+                    ('account', '=', account),
+                    ('party', '=', party),
+                    ('reconciliation', '=', None),
+                    ])
+        self.assertEqual(len(to_reconcile), 2)
+
+
+class CombinationMatcherTestCase(unittest.TestCase):
+    'Test CombinationMatcher'
+
+    def brute_force(self, lines, max_lines, span=None, tolerance=0):
+        'Reference implementation based on itertools.combinations'
+        lines = list(lines)
+        result = []
+        for size in range(2, max_lines + 1):
+            for limit in sorted({0, tolerance}):
+                for group in combinations(list(lines), size):
+                    if abs(sum(x[1] for x in group)) > limit:
+                        continue
+                    if span is not None and (
+                            max(x[2] for x in group)
+                            - min(x[2] for x in group) > span):
+                        continue
+                    if any(x not in lines for x in group):
+                        continue
+                    result.append([x[0] for x in group])
+                    for line in group:
+                        lines.remove(line)
+        return result
+
+    def test_same_result_as_brute_force(self):
+        'Test matcher returns the same groups as brute force'
+        for seed in range(300):
+            generator = random.Random(seed)
+            lines = [(i, Decimal(generator.randint(-80, 80)) / 10)
+                for i in range(generator.randint(0, 12))]
+            max_lines = generator.randint(2, 6)
+            matcher = CombinationMatcher(lines)
+            result = []
+            for size in range(2, max_lines + 1):
+                result.extend(matcher.find(size))
+            self.assertEqual(result, self.brute_force(lines, max_lines))
+
+    def test_fresh_lines(self):
+        'Test matcher only returns groups with fresh lines'
+        for seed in range(300):
+            generator = random.Random(seed)
+            lines = [(i, Decimal(generator.randint(-9, 9)))
+                for i in range(generator.randint(0, 12))]
+            max_lines = generator.randint(2, 6)
+            fresh = generator.randint(0, len(lines))
+            matched = {i for ids in self.brute_force(lines[:fresh], max_lines)
+                for i in ids}
+            lines = [x for x in lines if x[0] not in matched]
+            matcher = CombinationMatcher(lines,
+                fresh=fresh - len(matched))
+            result = []
+            for size in range(2, max_lines + 1):
+                result.extend(matcher.find(size))
+            self.assertEqual(result, self.brute_force(lines, max_lines))
+
+    def test_span(self):
+        'Test matcher only returns groups within the span'
+        for seed in range(300):
+            generator = random.Random(seed)
+            lines = [(i, Decimal(generator.randint(-9, 9)),
+                    generator.randint(0, 30))
+                for i in range(generator.randint(0, 14))]
+            lines.sort(key=lambda x: x[2])
+            max_lines = generator.randint(2, 6)
+            span = generator.randint(0, 20)
+            matcher = CombinationMatcher(lines, span=span)
+            result = []
+            for size in range(2, max_lines + 1):
+                result.extend(matcher.find(size))
+            self.assertEqual(result,
+                self.brute_force(lines, max_lines, span))
+
+    def test_tolerance(self):
+        'Test matcher returns the groups that sum within the tolerance'
+        for seed in range(300):
+            generator = random.Random(seed)
+            lines = [(i, Decimal(generator.randint(-80, 80)) / 10,
+                    generator.randint(0, 30))
+                for i in range(generator.randint(0, 12))]
+            lines.sort(key=lambda x: x[2])
+            max_lines = generator.randint(2, 6)
+            span = generator.choice([None, generator.randint(0, 20)])
+            tolerance = Decimal(generator.randint(0, 5)) / 10
+            matcher = CombinationMatcher(lines, span=span,
+                tolerance=tolerance)
+            result = []
+            for size in range(2, max_lines + 1):
+                result.extend(matcher.find(size))
+            self.assertEqual(result,
+                self.brute_force(lines, max_lines, span, tolerance))
+
+    def test_pruned_combinations(self):
+        'Test matcher does not search combinations that can not sum zero'
+        lines = [(i, Decimal(i + 1)) for i in range(30)] + [(30, Decimal(-1))]
+        matcher = CombinationMatcher(lines)
+        self.assertEqual(list(matcher.find(3)), [])
+        # Only the first line of each combination is evaluated
+        self.assertLessEqual(matcher.count, len(lines))
+
+    def test_continue_after_deadline(self):
+        'Test matcher continues with a new deadline after reaching one'
+        generator = random.Random(0)
+        lines = [(i, Decimal(generator.randint(-20, 20)))
+            for i in range(40)]
+        matcher = CombinationMatcher(lines, deadline=time.monotonic() - 1)
+        result = []
+        for size in range(2, 5):
+            result.extend(matcher.find(size))
+            while matcher.timed_out:
+                matcher.deadline = None
+                matcher.timed_out = False
+                result.extend(matcher.find(size))
+        self.assertEqual(result, self.brute_force(lines, 4))
+
+    def test_tolerance_exact_first(self):
+        'Test exact groups are preferred to the ones within the tolerance'
+        lines = [(1, Decimal('100.00')), (2, Decimal('-99.99')),
+            (3, Decimal('-100.00'))]
+        matcher = CombinationMatcher(lines, tolerance=Decimal('0.05'))
+        self.assertEqual(list(matcher.find(2)), [[1, 3]])
+        lines = [(1, Decimal('50.00')), (2, Decimal('50.01')),
+            (3, Decimal('-100.00')), (4, Decimal('50.00'))]
+        matcher = CombinationMatcher(lines, tolerance=Decimal('0.05'))
+        self.assertEqual(list(matcher.find(3)), [[1, 3, 4]])
+        lines = [(1, Decimal('25.00')), (2, Decimal('25.01')),
+            (3, Decimal('25.00')), (4, Decimal('-75.00')),
+            (5, Decimal('25.00')), (6, Decimal('-25.01'))]
+        matcher = CombinationMatcher(lines, tolerance=Decimal('0.05'))
+        self.assertEqual(list(matcher.find(4)), [[1, 3, 4, 5]])
+        self.assertEqual(list(matcher.find(2)), [[2, 6]])
+
+    def test_subset_sum(self):
+        'Test subset sum returns valid groups and leaves none behind'
+        for seed in range(300):
+            generator = random.Random(seed)
+            lines = [(i, Decimal(generator.randint(-80, 80)) / 10,
+                    generator.randint(0, 30))
+                for i in range(generator.randint(0, 12))]
+            max_lines = generator.randint(2, 9)
+            span = generator.choice([None, generator.randint(0, 20)])
+            tolerance = Decimal(generator.randint(0, 3)) / 10
+            matcher = SubsetSumMatcher(lines, span=span,
+                tolerance=tolerance)
+            amounts = {x[0]: x[1] for x in lines}
+            dates = {x[0]: x[2] for x in lines}
+            matched = set()
+            for ids in matcher.find(max_lines):
+                self.assertTrue(2 <= len(ids) <= max_lines)
+                self.assertFalse(matched & set(ids))
+                self.assertLessEqual(abs(sum(amounts[i] for i in ids)),
+                    tolerance)
+                if span is not None:
+                    self.assertLessEqual(
+                        max(dates[i] for i in ids)
+                        - min(dates[i] for i in ids), span)
+                matched.update(ids)
+            remaining = [x for x in lines if x[0] not in matched]
+            for line in remaining:
+                others = [x for x in remaining if x[1] * line[1] < 0]
+                for size in range(1, max_lines):
+                    for group in combinations(others, size):
+                        group_dates = [x[2] for x in group] + [line[2]]
+                        if (span is not None
+                                and max(group_dates) - min(group_dates)
+                                > span):
+                            continue
+                        self.assertGreater(
+                            abs(line[1] + sum(x[1] for x in group)),
+                            tolerance)
+
+    def test_subset_sum_deadline(self):
+        'Test subset sum only scans the lines of the opposite sign'
+        lines = [(i, Decimal(10), i % 30) for i in range(6000)]
+        for span in [None, 10]:
+            matcher = SubsetSumMatcher(lines, span=span)
+            start = time.perf_counter()
+            self.assertEqual(list(matcher.find(10)), [])
+            self.assertLess(time.perf_counter() - start, 1)
+            self.assertEqual(matcher.count, 0)
+        lines += [(6000 + i, Decimal(-7), i % 30) for i in range(6000)]
+        for span in [None, 10]:
+            matcher = SubsetSumMatcher(lines, time.monotonic() - 1,
+                span=span)
+            start = time.perf_counter()
+            self.assertEqual(list(matcher.find(10)), [])
+            self.assertTrue(matcher.timed_out)
+            self.assertLess(time.perf_counter() - start, 1)
+
+    def test_subset_sum_large(self):
+        'Test subset sum finds groups beyond the combinations sizes'
+        lines = [(i, Decimal(10 + i), 0) for i in range(40)]
+        lines.append((40, -sum(x[1] for x in lines[::3]), 0))
+        matcher = SubsetSumMatcher(lines)
+        ids, = matcher.find(20)
+        self.assertIn(40, ids)
+        self.assertGreater(len(ids), 6)
+        self.assertLessEqual(len(ids), 20)
+        self.assertEqual(sum(lines[i][1] for i in ids), Decimal(0))
+        matcher = SubsetSumMatcher(lines, max_states=10)
+        self.assertEqual(list(matcher.find(20)), [])
+        self.assertEqual(matcher.skipped, 1)
+
+    def test_estimate_cost(self):
+        'Test the estimated cost limits the size of the combinations'
+        self.assertEqual(estimate_cost(1, 2), 0)
+        self.assertEqual(estimate_cost(10, 2), 10)
+        self.assertEqual(estimate_cost(10, 3), 100)
+        self.assertEqual(estimate_cost(10, 4), 90)
+        self.assertEqual(max_size(10, 4, 1000), 4)
+        self.assertEqual(max_size(10, 4, 150), 3)
+        self.assertEqual(max_size(10, 4, 5), 1)
+        self.assertEqual(estimate_cost(10, 4, max_pairs=10), 450)
+        self.assertEqual(max_size(10, 4, 500, max_pairs=10), 3)
+
+    def test_max_pairs(self):
+        'Test the pairs are scanned when the table would be too large'
+        scanned = 0
+        for seed in range(100):
+            generator = random.Random(seed)
+            lines = [(i, Decimal(generator.randint(-80, 80)) / 10)
+                for i in range(generator.randint(0, 12))]
+            max_lines = generator.randint(4, 6)
+            matcher = CombinationMatcher(lines, max_pairs=5)
+            result = []
+            for size in range(2, max_lines + 1):
+                result.extend(matcher.find(size))
+            if matcher.scan_pairs:
+                self.assertIsNone(matcher.pairs)
+                scanned += 1
+            self.assertEqual(result, self.brute_force(lines, max_lines))
+        self.assertGreater(scanned, 0)
+
+    def test_pairs_span(self):
+        'Test the pair sums hold only fresh seconds within the span'
+        generator = random.Random(0)
+        lines = [(i, generator.randint(-20, 20), i // 3) for i in range(30)]
+        matcher = CombinationMatcher(lines, span=2, fresh=10)
+        matcher.active[12] = 0
+        matcher._build_pairs()
+        if isinstance(matcher.pairs, tuple):
+            pairs = sorted(zip(*(x.tolist() for x in matcher.pairs)))
+        else:
+            pairs = sorted((s, f, x) for s, p in matcher.pairs.items()
+                for f, x in p)
+        self.assertEqual(pairs, sorted(
+                (lines[f][1] + lines[x][1], f, x)
+                for f, x in combinations(range(30), 2)
+                if x >= 10 and lines[x][2] - lines[f][2] <= 2
+                and 12 not in {f, x}))
+
+    def test_scale_amounts(self):
+        'Test amounts are scaled to exact integers'
+        amounts, digits = scale_amounts(
+            [Decimal('1.5'), Decimal('-0.25'), Decimal('3.10'), 3], 1)
+        self.assertEqual(list(amounts), [150, -25, 310, 300])
+        self.assertEqual(digits, 2)
+
+    @unittest.skipIf(combination.numpy is None, 'numpy is not installed')
+    def test_numpy_pairs(self):
+        'Test the pair sums are computed with numpy when available'
+        matcher = CombinationMatcher([(i, i) for i in range(5)])
+        list(matcher.find(4))
+        self.assertIsInstance(matcher.pairs, tuple)
+
+
+class CombinationMatcherWithoutNumpyTestCase(CombinationMatcherTestCase):
+    'Test CombinationMatcher without numpy'
+
+    def setUp(self):
+        super().setUp()
+        patcher = patch.object(combination, 'numpy', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_numpy_pairs(self):
+        'Test the pair sums are computed without numpy'
+        matcher = CombinationMatcher([(i, i) for i in range(5)])
+        list(matcher.find(4))
+        self.assertIsInstance(matcher.pairs, dict)
+
+
+class LedgerGeneratorTestCase(unittest.TestCase):
+    'Test the LedgerGenerator of the benchmark'
+
+    def test_deterministic(self):
+        'Test the same seed generates the same ledger'
+        generator = LedgerGenerator(lines=200, parties=3, accounts=2,
+            distribution='lognormal', split_ratio=0.5, seed=1)
+        lines = generator.generate()
+        self.assertEqual(len(lines), 200)
+        self.assertEqual(lines, generator.generate())
+        self.assertNotEqual(lines, LedgerGenerator(lines=200, parties=3,
+                accounts=2, distribution='lognormal', split_ratio=0.5,
+                seed=2).generate())
+        self.assertEqual({x[0] for x in lines}, {0, 1})
+        self.assertTrue(all(x[3] == x[3].quantize(Decimal('0.01'))
+                for x in lines))
+
+    def test_balanced(self):
+        'Test the documents are fully paid without unmatched ratio'
+        lines = LedgerGenerator(lines=301, split_ratio=0.5,
+            unmatched_ratio=0, rule_ratio=1).generate()
+        documents = {}
+        for _, _, _, amount, description in lines:
+            number = description.split('nº')[1]
+            documents[number] = documents.get(number, 0) + amount
+        # Only the last document may be truncated
+        self.assertLessEqual(
+            len([x for x in documents.values() if x != 0]), 1)
+
+
+class MetricsTestCase(unittest.TestCase):
+    'Test metrics'
+
+    def test_buckets(self):
+        'Test the upper bounds of the histograms'
+        self.assertEqual(
+            [lines_bucket(x) for x in [0, 1, 2, 3, 4, 5, 1000]],
+            [1, 1, 2, 4, 4, 8, 1024])
+        self.assertEqual(
+            [seconds_bucket(x) for x in [0, 0.0005, 0.002, 0.5, 3]],
+            [0.001, 0.001, 0.01, 1, 10])
+
+
+class ReconcileSchedulerTestCase(unittest.TestCase):
+    'Test ReconcileScheduler'
+
+    def test_slice(self):
+        'Test the time is shared among windows and groups'
+        scheduler = ReconcileScheduler(timedelta(seconds=100))
+        scheduler.windows = 2
+        share = scheduler.share()
+        self.assertAlmostEqual(share - time.monotonic(), 50, delta=1)
+        self.assertAlmostEqual(
+            scheduler.slice(share, 4) - time.monotonic(), 12.5, delta=1)
+        self.assertLessEqual(scheduler.slice(share, 1), scheduler.deadline)
+        self.assertFalse(scheduler.expired())
+
+    def test_expired(self):
+        'Test the slices do not exceed the deadline once expired'
+        scheduler = ReconcileScheduler(timedelta(seconds=-1))
+        self.assertTrue(scheduler.expired())
+        self.assertEqual(scheduler.remaining(), 0)
+        self.assertEqual(scheduler.share(), scheduler.deadline)
+        self.assertEqual(scheduler.slice(scheduler.share(), 1),
+            scheduler.deadline)
+
+
+class ReconcilePlannerTestCase(unittest.TestCase):
+    'Test ReconcilePlanner'
+
+    def test_plan(self):
+        'Test empty spans are skipped and dense periods split'
+        start = date(2020, 1, 1)
+        histogram = [(start + timedelta(days=d), c) for d, c in [
+                (0, 5), (3, 5), (200, 3), (201, 100), (202, 100), (230, 1)]]
+        planner = ReconcilePlanner(histogram, 30, 50)
+        self.assertEqual(
+            [((s - start).days, (e - start).days)
+                for s, e in planner.plan(start, start + timedelta(days=365))],
+            [(0, 30), (170, 200), (171, 201), (172, 202), (200, 230)])
+
+    def test_plan_dates(self):
+        'Test the windows are limited to the dates'
+        start = date(2020, 1, 1)
+        histogram = [(start + timedelta(days=d), 1) for d in range(0, 100, 5)]
+        planner = ReconcilePlanner(histogram, 30, 1000)
+        windows = list(planner.plan(start + timedelta(days=12),
+                start + timedelta(days=50)))
+        self.assertEqual(windows[0][0], start + timedelta(days=15))
+        self.assertEqual(windows[-1][1], start + timedelta(days=50))
+        for (start1, end1), (start2, end2) in zip(windows, windows[1:]):
+            self.assertLessEqual((start2 - start1).days, 15)
+        self.assertEqual(list(planner.plan(start + timedelta(days=101),
+                    start + timedelta(days=200))), [])
+
+
+class ReconcileWindowTestCase(unittest.TestCase):
+    'Test ReconcileWindow'
+
+    def lines(self, start, count, group=(1, None)):
+        'Return count lines of group dated from start'
+        return [(i, group[0], group[1], start + timedelta(days=i),
+                Decimal(i) / 100, None)
+            for i in range(count)]
+
+    def test_slide(self):
+        'Test the lines are stored compact and evicted by date'
+        start = date(2020, 1, 1)
+        window = ReconcileWindow(digits=2)
+        self.assertEqual(
+            window.slide(start, start + timedelta(days=9),
+                self.lines(start, 10)), 10)
+        self.assertEqual(window.groups[(1, None)][3],
+            (3, (start + timedelta(days=3)).toordinal(), 3, None))
+        window.slide(start + timedelta(days=5), start + timedelta(days=9),
+            [])
+        self.assertEqual([x[0] for x in window.groups[(1, None)]],
+            [5, 6, 7, 8, 9])
+
+    def test_rescale(self):
+        'Test the amounts with more decimals than digits stay exact'
+        start = date(2020, 1, 1)
+        window = ReconcileWindow(digits=2)
+        window.slide(start, start + timedelta(days=9), [
+                (0, 1, None, start, Decimal('1.25'), None),
+                (1, 1, None, start, Decimal('-1.255'), None),
+                (2, 1, None, start, Decimal('0.005'), None),
+                ])
+        self.assertEqual(window.digits, 3)
+        self.assertEqual([x[2] for x in window.groups[(1, None)]],
+            [1250, -1255, 5])
+
+    def test_changed(self):
+        'Test the keys of the lines leaving a group are stored'
+        start = date(2020, 1, 1)
+        window = ReconcileWindow()
+        lines = [(0, 1, None, start, Decimal(1), 'A'),
+            (1, 1, None, start + timedelta(days=5), Decimal(1), 'A'),
+            (2, 2, None, start, Decimal(1), 'B')]
+        window.slide(start, start + timedelta(days=9), lines)
+        self.assertEqual(window.changed, {})
+        window.slide(start + timedelta(days=1), start + timedelta(days=9),
+            [])
+        self.assertEqual(window.changed, {(1, None): {'A'}, (2, None): {'B'}})
+        # The groups left with lines are processed without fresh lines
+        self.assertEqual(window.fresh, {(1, None): 1})
+
+    def test_max_lines(self):
+        'Test a group keeps at most max lines'
+        start = date(2020, 1, 1)
+        window = ReconcileWindow(max_lines=3)
+        window.slide(start, start + timedelta(days=99),
+            self.lines(start, 10) + self.lines(start, 2, (2, 1)))
+        self.assertEqual([x[0] for x in window.groups[(1, None)]],
+            [7, 8, 9])
+        self.assertEqual(len(window.groups[(2, 1)]), 2)
+        self.assertEqual(window.fresh, {(1, None): 0, (2, 1): 0})
+        self.assertEqual(window.evicted, 7)
+        self.assertEqual(window.truncated, {(1, None): 7})
+        window.slide(start + timedelta(days=1), start + timedelta(days=99),
+            [])
+        self.assertEqual(window.truncated, {})
+
+
+class RuleExpressionsTestCase(unittest.TestCase):
+    'Test RuleExpressions'
+
+    def sequential_key(self, expressions, description):
+        'Reference implementation searching each expression in turn'
+        for expression in expressions:
+            match = re.search(expression, description)
+            if match:
+                return match.group(1).replace(' ', '')
+
+    def test_same_key_as_sequential(self):
+        'Test combined expressions return the key of the first rule'
+        expressions = [
+            'nº((\\d|\\s)+)',
+            'REF-(?P<ref>[A-Z]+)',
+            '(\\d{3})$',
+            '(a)b\\1',
+            ]
+        descriptions = [
+            None,
+            '',
+            'Invoice nº 1 001',
+            'REF-ABC nº 12',
+            'REF-ABC 123',
+            'Payment 123',
+            'Payment aba 123',
+            'Payment abaa',
+            '123 REF-X',
+            ]
+        for count in range(1, len(expressions) + 1):
+            for selected in combinations(expressions, count):
+                rule_expressions = RuleExpressions(selected)
+                for description in descriptions:
+                    key = rule_expressions.key(description)
+                    if description:
+                        self.assertEqual(key,
+                            self.sequential_key(selected, description))
+                    else:
+                        self.assertIsNone(key)
+
+    def test_combined_pattern(self):
+        'Test expressions are combined only when possible'
+        self.assertIsNotNone(RuleExpressions(['a(b)', 'c(d)']).pattern)
+        self.assertIsNone(RuleExpressions(['a(b)']).pattern)
+        self.assertIsNone(RuleExpressions(['(a)\\1', 'c(d)']).pattern)
+        self.assertIsNone(RuleExpressions(
+                ['(?P<x>a)', '(?P<x>b)']).pattern)
+
+    def test_portable(self):
+        'Test expressions are portable only with the syntax whitelisted'
+        self.assertTrue(RuleExpressions(
+                ['nº([0-9 ]+)', '^(?:REF)-([A-Z0-9]{3,12})\\Z']).portable)
+        self.assertTrue(RuleExpressions(['[]\\-](a+)b*']).portable)
+        self.assertFalse(RuleExpressions(['a(b)', 'x([0-9]+)$']).portable)
+        for expression in [
+                'nº((\\d|\\s)+)',
+                '\\b([0-9]+)',
+                '(?P<ref>[0-9]+)',
+                '(?i)ref([0-9]+)',
+                'REF',
+                '(a)(b)',
+                'a(b)?',
+                '(a+)b*?',
+                'a+?([0-9]+)',
+                '([0-9]+)$',
+                'x(.+)',
+                'a|(b)',
+                '\\x41(b)',
+                'a{(b)',
+                'a{300}(b)',
+                '[[:digit:]](b)',
+                '[a-é](b)',
+                '(?=a)(b)',
+                ]:
+            with self.subTest(expression=expression):
+                self.assertFalse(RuleExpressions.is_portable(expression))
+
 
 del ModuleTestCase